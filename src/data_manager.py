@@ -1,10 +1,234 @@
+import os
+import csv
+import json
+import time
+import hashlib
+import threading
 import configparser
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+
+
+class Region(NamedTuple):
+    name: str
+    parent: str
+    size: str
+    download_link: str
+
+
+class DownloadResult(NamedTuple):
+    region: Region
+    path: str
+    # downloaded / unchanged / failed / process_failed（下载成功但 on_complete 抛出异常）
+    status: str
+    bytes_downloaded: int
+    message: str = ""
+
 
 class DataManager:
+    """
+    根据配置文件与 crawler/geofabrik_scrape.py 生成的 csv 下载 Geofabrik 的区域数据。
+
+    配置示例:
+        [download]
+        regions_csv = geofabrik_regions.csv
+        regions = China, Taiwan
+        output_dir = data
+        concurrency = 4
+
+        [parser]
+        # 可选，解析完成的 region 依次追加写入该数据库
+        db_path = db/boundary.duckdb
+        max_admin_level = 7
+
+        [root_boundary]
+        China = 270056
+        Taiwan = 449220
+    """
     config : configparser.ConfigParser
     def __init__(self, config_file_path : str):
         self.config = configparser.ConfigParser()
+        # region 名称中可能包含大小写，保持原样
+        self.config.optionxform = str
         self.config.read(config_file_path)
-    
-    def download(self):
-        pass
+        self.regions_csv: str = self.config.get("download", "regions_csv", fallback="geofabrik_regions.csv")
+        self.output_dir: str = self.config.get("download", "output_dir", fallback="data")
+        self.concurrency: int = self.config.getint("download", "concurrency", fallback=4)
+        self.chunk_size: int = self.config.getint("download", "chunk_size", fallback=1024 * 1024)
+        self.timeout: int = self.config.getint("download", "timeout", fallback=60)
+        self.max_retry: int = self.config.getint("download", "max_retry", fallback=3)
+        self._local = threading.local()
+
+    def load_regions(self) -> list[Region]:
+        with open(self.regions_csv, newline="", encoding="utf-8") as f:
+            regions = [Region(row["name"], row["parent"], row["size"], row["download_link"])
+                       for row in csv.DictReader(f) if row.get("download_link")]
+        wanted = [name.strip() for name in self.config.get("download", "regions", fallback="").split(",") if name.strip()]
+        if not wanted:
+            return regions
+        by_name = {region.name: region for region in regions}
+        for name in wanted:
+            if name not in by_name:
+                print(f"region {name} is not in {self.regions_csv}")
+        return [by_name[name] for name in wanted if name in by_name]
+
+    def local_path(self, region: Region) -> str:
+        return os.path.join(self.output_dir, region.download_link.rsplit("/", 1)[-1])
+
+    def download(self, regions: Optional[list[Region]] = None,
+                 on_complete: Optional[Callable[[DownloadResult], None]] = None) -> list[DownloadResult]:
+        """
+        并发下载所有 region，每个文件完成（或确认未变化）后立即在调用线程中回调 on_complete，
+        因此可以在其余文件仍在下载时开始解析已完成的文件。
+        on_complete 抛出的异常只影响对应的 region，记录为 process_failed 后继续处理其余的 region
+        """
+        if regions is None:
+            regions = self.load_regions()
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+        results: list[DownloadResult] = list()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="download") as executor:
+            futures = [executor.submit(self.download_region, region) for region in regions]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"download {result.region.name} {result.status}: {result.path} "
+                      f"({result.bytes_downloaded} bytes) {result.message}")
+                if on_complete is not None and result.status != "failed":
+                    try:
+                        on_complete(result)
+                    except Exception as e:
+                        print(f"process {result.region.name} fail: {e!r}")
+                        result = result._replace(status="process_failed", message=repr(e))
+                results.append(result)
+        return results
+
+    def download_and_parse(self, regions: Optional[list[Region]] = None) -> dict[str, "OsmAdminBoundaryParser"]:
+        from parser import OsmAdminBoundaryParser
+
+        max_admin_level = self.config.getint("parser", "max_admin_level", fallback=7)
+        db_path = self.config.get("parser", "db_path", fallback=None)
+        parsers: dict[str, OsmAdminBoundaryParser] = dict()
+
+        # on_complete 在调用线程中依次执行，不会有多个 region 同时写入数据库
+        def parse(result: DownloadResult) -> None:
+            root_boundary_id = self.config.getint("root_boundary", result.region.name, fallback=None)
+            parser = OsmAdminBoundaryParser()
+            parser.parse(result.path, root_boundary_id=root_boundary_id, max_admin_level=max_admin_level)
+            if db_path:
+                parser.save_to_database(overwrite=False, db_path=db_path)
+            parsers[result.region.name] = parser
+
+        results = self.download(regions, on_complete=parse)
+        failed = [result.region.name for result in results if result.status in ("failed", "process_failed")]
+        if failed:
+            print(f"{len(failed)} regions are not parsed: {', '.join(failed)}")
+        return parsers
+
+    @property
+    def session(self) -> requests.Session:
+        # requests.Session 不保证线程安全，每个下载线程各自持有一个
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def download_region(self, region: Region) -> DownloadResult:
+        path = self.local_path(region)
+        last_error = ""
+        for retry in range(self.max_retry):
+            try:
+                return self.download_file(region, path)
+            except (requests.RequestException, OSError, ValueError) as e:
+                last_error = str(e)
+                print(f"download {region.name} fail ({retry + 1}/{self.max_retry}): {e}")
+                time.sleep(2 ** retry)
+        return DownloadResult(region, path, "failed", 0, last_error)
+
+    def download_file(self, region: Region, path: str) -> DownloadResult:
+        url = region.download_link
+        meta_path = f"{path}.meta.json"
+        part_path = f"{path}.part"
+        meta = self.read_meta(meta_path)
+        expected_md5 = self.fetch_md5(url)
+
+        # 1. 服务端提供 md5 时直接与本地文件比对
+        if os.path.exists(path) and expected_md5 is not None:
+            if meta.get("md5") == expected_md5 or file_md5(path) == expected_md5:
+                return DownloadResult(region, path, "unchanged", 0, "md5 match")
+
+        headers: dict[str, str] = dict()
+        # 2. 没有 md5 时使用条件请求判断文件是否变化
+        if os.path.exists(path) and expected_md5 is None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        # 3. 存在未完成的 .part 文件时断点续传，If-Range 保证续传的是同一个版本
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > 0 and meta.get("part_etag"):
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = meta["part_etag"]
+        else:
+            offset = 0
+
+        downloaded = 0
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                return DownloadResult(region, path, "unchanged", 0, "not modified")
+            if response.status_code == 416:
+                # .part 已经完整，直接进入校验
+                pass
+            else:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                meta["part_etag"] = response.headers.get("ETag")
+                self.write_meta(meta_path, meta)
+                with open(part_path, "ab" if offset > 0 else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        downloaded += len(chunk)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        actual_md5 = file_md5(part_path)
+        if expected_md5 is not None and actual_md5 != expected_md5:
+            # 校验失败时删除 .part，下次重试从头下载
+            os.remove(part_path)
+            raise ValueError(f"md5 mismatch for {url}: expected {expected_md5}, actual {actual_md5}")
+        os.replace(part_path, path)
+        self.write_meta(meta_path, {"url": url, "etag": etag, "last_modified": last_modified, "md5": actual_md5})
+        return DownloadResult(region, path, "downloaded", downloaded, "resumed" if offset > 0 else "")
+
+    def fetch_md5(self, url: str) -> Optional[str]:
+        # Geofabrik 为每个文件提供 `<file>.md5`，内容为 `<md5>  <filename>`
+        try:
+            response = self.session.get(f"{url}.md5", timeout=self.timeout)
+            if response.status_code != 200:
+                return None
+            value = response.text.strip().split()[0].lower()
+            return value if len(value) == 32 else None
+        except (requests.RequestException, IndexError):
+            return None
+
+    def read_meta(self, meta_path: str) -> dict:
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def write_meta(self, meta_path: str, meta: dict) -> None:
+        tmp_path = f"{meta_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+
+def file_md5(path: str, chunk_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
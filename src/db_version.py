@@ -0,0 +1,94 @@
+"""
+数据库版本发布: parser 每次都把数据写入新的带版本号的文件，写完后原子地替换指针文件完成发布，
+查询进程只打开指针指向的版本，刷新数据时不会读到写了一半的文件，也不需要停止服务。
+
+指针文件（默认 db/boundary.current）内容:
+    {"version": "20260101120000000000", "db": "boundary-<version>.duckdb", "snapshot": "boundary-<version>.snapshot"}
+db 与 snapshot 为相对于指针文件所在目录的文件名，snapshot 可以为 null
+"""
+import os
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+
+class DatabaseVersion(NamedTuple):
+    version: str
+    db_path: str
+    snapshot_path: Optional[str]
+
+
+def pointer_path(db_dir: str = "db", name: str = "boundary") -> str:
+    return os.path.join(db_dir, f"{name}.current")
+
+
+def new_version() -> str:
+    # 精确到微秒，按字符串排序即为发布顺序。使用 UTC，夏令时结束时本地时间回拨不会让新版本排在旧版本之前
+    return datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+
+
+def version_paths(db_dir: str, name: str, version: str, snapshot: bool = False) -> DatabaseVersion:
+    return DatabaseVersion(
+        version,
+        os.path.join(db_dir, f"{name}-{version}.duckdb"),
+        os.path.join(db_dir, f"{name}-{version}.snapshot") if snapshot else None)
+
+
+def read_current(pointer: str) -> Optional[DatabaseVersion]:
+    """读取指针文件，不存在时返回 None"""
+    try:
+        with open(pointer, encoding="utf-8") as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        return None
+    base_dir = os.path.dirname(pointer)
+    return DatabaseVersion(
+        content["version"],
+        os.path.join(base_dir, content["db"]),
+        os.path.join(base_dir, content["snapshot"]) if content.get("snapshot") else None)
+
+
+def publish(pointer: str, version: DatabaseVersion) -> None:
+    """先写临时文件并落盘，再用 os.replace 原子地替换指针文件，读取方只会看到旧版本或新版本"""
+    Path(pointer).parent.mkdir(parents=True, exist_ok=True)
+    content = {
+        "version": version.version,
+        "db": os.path.basename(version.db_path),
+        "snapshot": os.path.basename(version.snapshot_path) if version.snapshot_path else None,
+    }
+    tmp_path = f"{pointer}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(content, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer)
+    print(f"publish database version {version.version} to {pointer}")
+
+
+def prune_versions(pointer: str, name: str = "boundary", keep: int = 3) -> list[str]:
+    """
+    删除最近 keep 个版本之外的旧版本文件，当前版本始终保留。
+    仍在使用旧版本的查询进程已经打开了文件，删除目录项不影响它们继续读完正在进行的查询
+    """
+    base_dir = os.path.dirname(pointer) or "."
+    current = read_current(pointer)
+    prefix = f"{name}-"
+    versions: set[str] = set()
+    for file_name in os.listdir(base_dir):
+        if file_name.startswith(prefix) and file_name.endswith((".duckdb", ".snapshot", ".duckdb.wal")):
+            versions.add(file_name[len(prefix):].split(".", 1)[0])
+    keep_versions = set(sorted(versions, reverse=True)[:keep])
+    if current is not None:
+        keep_versions.add(current.version)
+    removed: list[str] = list()
+    for file_name in os.listdir(base_dir):
+        if not file_name.startswith(prefix):
+            continue
+        version = file_name[len(prefix):].split(".", 1)[0]
+        if version in versions and version not in keep_versions:
+            os.remove(os.path.join(base_dir, file_name))
+            removed.append(file_name)
+    if removed:
+        print(f"prune {len(removed)} files of old database versions")
+    return removed
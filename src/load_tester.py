@@ -0,0 +1,103 @@
+"""
+对本地 reverse geocoding 服务做压测
+
+每个并发客户端维持一条 keep-alive 连接，在指定时长内不断发送随机坐标的单点请求，
+结束后输出吞吐与延迟分位数。--bulk 模式下改为发送批量请求并统计每秒处理的点数。
+
+用法:
+  python load_tester.py [--url http://127.0.0.1:8080] [--concurrency 64] [--duration 10]
+                      [--bbox 73,18,135,54] [--bulk 0]
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:] if line)}
+    if "content-length" in headers:
+        return status, await reader.readexactly(int(headers["content-length"]))
+    body = b""
+    while True:
+        size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+        chunk = await reader.readexactly(size + 2)
+        if size == 0:
+            return status, body
+        body += chunk[:-2]
+
+
+def random_point(bbox: tuple[float, float, float, float]) -> tuple[float, float]:
+    return random.uniform(bbox[0], bbox[2]), random.uniform(bbox[1], bbox[3])
+
+
+async def client(host: str, port: int, bbox: tuple[float, float, float, float], deadline: float,
+                 bulk: int, fallback: bool, latencies: list[float], errors: list[int]) -> int:
+    reader, writer = await asyncio.open_connection(host, port)
+    points_done = 0
+    fallback_param = "1" if fallback else "0"
+    try:
+        while time.perf_counter() < deadline:
+            if bulk > 0:
+                body = "".join(json.dumps(random_point(bbox)) + "\n" for _ in range(bulk)).encode("utf-8")
+                request = (f"POST /reverse/batch?fallback={fallback_param} HTTP/1.1\r\nHost: {host}\r\n"
+                           f"Content-Type: application/x-ndjson\r\nContent-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+            else:
+                lon, lat = random_point(bbox)
+                request = (f"GET /reverse?lon={lon}&lat={lat}&fallback={fallback_param} HTTP/1.1\r\n"
+                           f"Host: {host}\r\n\r\n").encode("latin-1")
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, _ = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[0] += 1
+            points_done += bulk if bulk > 0 else 1
+    finally:
+        writer.close()
+    return points_done
+
+
+async def run(url: str, concurrency: int, duration: float, bbox: tuple[float, float, float, float],
+              bulk: int, fallback: bool) -> None:
+    parts = urlsplit(url)
+    host, port = parts.hostname or "127.0.0.1", parts.port or 80
+    latencies: list[float] = list()
+    errors = [0]
+    start = time.perf_counter()
+    deadline = start + duration
+    done = await asyncio.gather(*[client(host, port, bbox, deadline, bulk, fallback, latencies, errors)
+                                  for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def quantile(q: float) -> float:
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+
+    print(f"requests: {len(latencies)}, errors: {errors[0]}, points: {sum(done)}, elapsed: {elapsed:.2f}s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s, {sum(done) / elapsed:.1f} points/s")
+    print(f"latency ms: p50 {quantile(0.5):.2f}, p90 {quantile(0.9):.2f}, p99 {quantile(0.99):.2f}, "
+          f"max {quantile(1.0):.2f}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="load test for the reverse geocoding http service")
+    arg_parser.add_argument("--url", default="http://127.0.0.1:8080")
+    arg_parser.add_argument("--concurrency", type=int, default=64)
+    arg_parser.add_argument("--duration", type=float, default=10.0)
+    arg_parser.add_argument("--bbox", default="73,18,135,54", help="min_lon,min_lat,max_lon,max_lat")
+    arg_parser.add_argument("--bulk", type=int, default=0, help="points per batch request, 0 for single point requests")
+    arg_parser.add_argument("--fallback", action="store_true", help="allow overpass fallback for misses")
+    args = arg_parser.parse_args()
+    bbox = tuple(float(x) for x in args.bbox.split(","))
+    asyncio.run(run(args.url, args.concurrency, args.duration, bbox, args.bulk, args.fallback))
+
+
+if __name__ == "__main__":
+    main()
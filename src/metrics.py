@@ -0,0 +1,206 @@
+import sys
+import time
+import threading
+import resource
+import cProfile
+import pstats
+import tracemalloc
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+# 默认的延迟直方图分桶（秒），从 10us 到 30s
+DEFAULT_LATENCY_BUCKETS: tuple[float, ...] = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+    0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0,
+)
+# 批量大小等计数类直方图的分桶
+DEFAULT_SIZE_BUCKETS: tuple[float, ...] = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+# 距离类直方图的分桶（米）
+DEFAULT_DISTANCE_BUCKETS: tuple[float, ...] = (1, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# 不是延迟的直方图使用各自的分桶，否则分位数都落在延迟分桶的最后一个桶里
+DEFAULT_BUCKETS_BY_NAME: dict[str, tuple[float, ...]] = {
+    "query.batch.size": DEFAULT_SIZE_BUCKETS,
+    "server.micro_batch.size": DEFAULT_SIZE_BUCKETS,
+    "router.partitions_per_query": DEFAULT_SIZE_BUCKETS,
+    "query.snap.distance_meters": DEFAULT_DISTANCE_BUCKETS,
+}
+
+
+class MetricsSink:
+    """
+    metrics 输出的基类，默认丢弃所有数据。
+    需要接入其他监控系统（statsd、prometheus 等）时继承该类并覆盖下列方法即可
+    """
+    def increment(self, name: str, value: int = 1) -> None:
+        pass
+
+    def observe(self, name: str, value: float) -> None:
+        pass
+
+    def gauge(self, name: str, value: float) -> None:
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets: tuple[float, ...] = buckets
+        # 最后一个桶用于记录超过最大分桶上界的值
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def __repr__(self):
+        mean = self.sum / self.count if self.count else 0.0
+        return (f"count: {self.count}, mean: {mean:.6f}, p50<={self.quantile(0.5)}, "
+                f"p99<={self.quantile(0.99)}, max: {self.max:.6f}")
+
+
+class InMemoryMetrics(MetricsSink):
+    """
+    在进程内汇总 counter、直方图与 gauge，适合构建脚本和调试使用。
+    线程安全，HTTP 服务的事件循环、查询线程与 overpass 线程池共用同一个实例
+    @buckets: 直方图默认的分桶
+    @buckets_by_name: 指定名称的直方图使用的分桶，默认为批量大小与吸附距离等非延迟指标的分桶
+    """
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS,
+                 buckets_by_name: Optional[dict[str, tuple[float, ...]]] = None):
+        self.buckets = buckets
+        self.buckets_by_name: dict[str, tuple[float, ...]] = \
+            dict(buckets_by_name if buckets_by_name is not None else DEFAULT_BUCKETS_BY_NAME)
+        self.counters: dict[str, int] = dict()
+        self.histograms: dict[str, Histogram] = dict()
+        self.gauges: dict[str, float] = dict()
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.buckets_by_name.get(name, self.buckets))
+            self.histograms[name].observe(value)
+
+    def gauge(self, name: str, value: float) -> None:
+        # gauge 记录高水位，便于观察各阶段的内存峰值
+        with self.lock:
+            self.gauges[name] = max(value, self.gauges.get(name, value))
+
+    def snapshot(self) -> dict[str, dict]:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: {"count": h.count, "sum": h.sum, "max": h.max,
+                                      "p50": h.quantile(0.5), "p99": h.quantile(0.99)}
+                               for name, h in self.histograms.items()},
+                "gauges": dict(self.gauges),
+            }
+
+    def print_summary(self) -> None:
+        with self.lock:
+            for name in sorted(self.counters):
+                print(f"counter {name}: {self.counters[name]}")
+            for name in sorted(self.histograms):
+                print(f"histogram {name}: {self.histograms[name]}")
+            for name in sorted(self.gauges):
+                print(f"gauge {name}: {self.gauges[name]}")
+
+
+def max_rss_bytes() -> int:
+    # linux 下 ru_maxrss 单位为 KB，macOS 下为 byte
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+# 进行中的阶段栈。cProfile 与 tracemalloc 都是进程级的，嵌套的阶段不能各自启动 profiler，
+# 也不能在重置 tracemalloc 峰值时丢掉外层阶段已经记录的峰值
+_active_phases: list[dict] = list()
+_active_profiler: Optional[cProfile.Profile] = None
+
+
+@contextmanager
+def phase(metrics: MetricsSink, name: str, profile_dir: Optional[str] = None,
+          trace_memory: bool = False):
+    """
+    统计一个阶段的耗时与内存，结果写入:
+     - `{name}.seconds`
+     - `{name}.peak_rss_growth_bytes`: 该阶段内进程 RSS 峰值的增长量
+     - `{name}.process_peak_rss_bytes`: 阶段结束时整个进程的 RSS 峰值
+    @profile_dir: 不为 None 时使用 cProfile 采样该阶段，结果保存为 `{profile_dir}/{name}.prof`。
+                  阶段嵌套时只有最外层的阶段采样，其结果包含所有内层阶段
+    @trace_memory: 为 True 时使用 tracemalloc 记录该阶段 python 对象分配的峰值，开销较大
+    """
+    global _active_profiler
+    profiler: Optional[cProfile.Profile] = None
+    if profile_dir is not None and _active_profiler is None:
+        profiler = cProfile.Profile()
+    frame = {"tracemalloc_peak": 0}
+    started_tracemalloc = False
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracemalloc = True
+        # 重置峰值之前先把外层阶段到目前为止的峰值记下来
+        if _active_phases:
+            parent = _active_phases[-1]
+            parent["tracemalloc_peak"] = max(parent["tracemalloc_peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    _active_phases.append(frame)
+
+    print(f"{name} start")
+    rss_before = max_rss_bytes()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+        _active_profiler = profiler
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _active_profiler = None
+        elapsed = time.perf_counter() - start
+        _active_phases.pop()
+        metrics.observe(f"{name}.seconds", elapsed)
+        rss_after = max_rss_bytes()
+        metrics.gauge(f"{name}.peak_rss_growth_bytes", rss_after - rss_before)
+        metrics.gauge(f"{name}.process_peak_rss_bytes", rss_after)
+        if trace_memory:
+            peak = max(frame["tracemalloc_peak"], tracemalloc.get_traced_memory()[1])
+            metrics.gauge(f"{name}.tracemalloc_peak_bytes", peak)
+            # 内层阶段的峰值同样属于外层阶段
+            if _active_phases:
+                parent = _active_phases[-1]
+                parent["tracemalloc_peak"] = max(parent["tracemalloc_peak"], peak)
+            if started_tracemalloc:
+                tracemalloc.stop()
+        if profiler is not None:
+            Path(profile_dir).mkdir(parents=True, exist_ok=True)
+            profile_path = f"{profile_dir}/{name}.prof"
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(10)
+            print(f"{name} profile saved as {profile_path}")
+        print(f"{name} finished in {elapsed:.3f}s")
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 from shapely import MultiPolygon
 
 @dataclass
@@ -17,6 +17,7 @@ class Boundary:
     outer_boundary_id_list: list[int]
     inner_boundary_id_list: list[int]
     geom: type[MultiPolygon]
+    repair_status: Optional[str]
 
     def __init__(self, osm_id, name, name_en, name_zh, name_preference, admin_level, subarea_id_list, outer_boundary_id_list, inner_boundary_id_list):
         self.osm_id = osm_id
@@ -31,6 +32,7 @@ class Boundary:
         self.outer_boundary_id_list = outer_boundary_id_list
         self.inner_boundary_id_list = inner_boundary_id_list
         self.geom = None
+        self.repair_status = None
 
     def __repr__(self):
         return f"{self.name}({self.osm_id}), name_en: {self.name_en}, name_zh: {self.name_zh}, admin_level: {self.admin_level}\n"
@@ -55,3 +57,13 @@ class Way(NamedTuple):
     osm_id: int
     geom: any
     close: bool
+
+
+class QueryResult(NamedTuple):
+    names: list[str]
+    # local / snap / overpass / miss / error
+    source: str
+    # source 为 snap 时到最近边界的距离（米），其余情况为 None
+    distance: Optional[float] = None
+    # 与 names 一一对应的 (admin_level, osm_id)，只有 local 与 snap 结果有，用于合并多个分区的结果
+    chain: Optional[list[tuple[int, int]]] = None
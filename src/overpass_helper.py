@@ -1,14 +1,29 @@
+import time
 import overpass
 from shapely.geometry import LineString, Polygon
 from typing import Any, Optional
+from metrics import MetricsSink
 from model import *
 from utils import *
 
 
 class OverpassHelper():
-    def __init__(self, endpoint: str = "https://overpass-api.de/api/interpreter", timeout: int = 30, max_retry: int = 3):
+    def __init__(self, endpoint: str = "https://overpass-api.de/api/interpreter", timeout: int = 30, max_retry: int = 3,
+                 metrics: Optional[MetricsSink] = None):
         self.api = overpass.API(endpoint = endpoint, timeout = timeout)
         self.max_retry = max_retry
+        self.metrics: MetricsSink = metrics if metrics is not None else MetricsSink()
+
+    def request(self, kind: str, query: str, verbosity: str):
+        self.metrics.increment(f"overpass.{kind}.request")
+        start = time.perf_counter()
+        try:
+            return self.api.get(query, responseformat='json', verbosity=verbosity)
+        except:
+            self.metrics.increment(f"overpass.{kind}.error")
+            raise
+        finally:
+            self.metrics.observe(f"overpass.{kind}.seconds", time.perf_counter() - start)
     
     def get_ways(self, way_ids: list[int]):
         if len(way_ids) == 0:
@@ -16,7 +31,7 @@ class OverpassHelper():
         way_ids_str = ",".join([str(way_id) for way_id in way_ids])
         for _ in range(self.max_retry):
             try:
-                result = self.api.get(f'way(id:{way_ids_str});', responseformat='json', verbosity='geom')
+                result = self.request('way', f'way(id:{way_ids_str});', 'geom')
                 if result and result['elements']:
                     return result
             except:
@@ -30,7 +45,7 @@ class OverpassHelper():
         relation_ids_str = ",".join([str(relation_id) for relation_id in relation_ids])
         for _ in range(self.max_retry):
             try:
-                result = self.api.get(f'relation(id:{relation_ids_str});', responseformat='json', verbosity='body')
+                result = self.request('relation', f'relation(id:{relation_ids_str});', 'body')
                 if result and result['elements']:
                     return result
             except:
@@ -40,7 +55,7 @@ class OverpassHelper():
     
     def get_reverse_geocoding(self, lon: float, lat: float, name_preference: Optional[str] = None) -> list[Boundary]:
         try:
-            result = self.api.get(f'is_in({lat},{lon});relation(pivot)[boundary=administrative];', responseformat='json', verbosity='tags')
+            result = self.request('is_in', f'is_in({lat},{lon});relation(pivot)[boundary=administrative];', 'tags')
             if result and result['elements']:
                 ancestor_boundary_list: list[Boundary] = list()
                 for relation in result['elements']:
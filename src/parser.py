@@ -1,5 +1,6 @@
 import osmium
 import os
+import json
 import duckdb
 import logging
 import shapely
@@ -10,11 +11,21 @@ from collections import Counter
 from typing import Optional
 from pathlib import Path
 from overpass_helper import OverpassHelper
+from metrics import MetricsSink, phase
+from db_version import DatabaseVersion, new_version, pointer_path, prune_versions, publish, version_paths
+from snapshot import export_query_snapshot, load_boundaries
+from topology import *
+from utils_duckdb import load_spatial_extension
 from model import *
 from utils import *
 
 class OsmAdminBoundaryParser:
-    def __init__(self, overpass_endpoint: str = "https://overpass-api.de/api/interpreter"):
+    # @metrics: 各阶段耗时、计数与内存高水位的输出，默认丢弃
+    # @profile_dir: 不为 None 时对每个阶段做 cProfile 采样并保存到该目录
+    # @trace_memory: 是否使用 tracemalloc 记录每个阶段的 python 内存分配峰值
+    def __init__(self, overpass_endpoint: str = "https://overpass-api.de/api/interpreter",
+                 metrics: Optional[MetricsSink] = None, profile_dir: Optional[str] = None,
+                 trace_memory: bool = False):
         self.boundaries: dict[int, Boundary] = dict()
         self.root_boundary: int = None
         self.max_admin_level: int = None
@@ -23,31 +34,41 @@ class OsmAdminBoundaryParser:
         self.small_admin_level_boundaries: set[int] = set()
         self.ways: dict[int, Way] = dict()
         self.way_need: set[int] = set()
-        self.overpass_helper = OverpassHelper(overpass_endpoint)
+        self.metrics: MetricsSink = metrics if metrics is not None else MetricsSink()
+        self.profile_dir: Optional[str] = profile_dir
+        self.trace_memory: bool = trace_memory
+        self.overpass_helper = OverpassHelper(overpass_endpoint, metrics=self.metrics)
         self.relation_fixed: list[int] = list()
+
+    def phase(self, name: str):
+        return phase(self.metrics, name, self.profile_dir, self.trace_memory)
     
     def parse(self, file_path: str, root_boundary_id: Optional[int] = None, max_admin_level: int = 7, name_preference: Optional[str] = None):
-        print(f"parse start {datetime.now()}")
-        self.parse_relation(file_path, root_boundary_id, max_admin_level, name_preference)
-        print(f"parse relation finished {datetime.now()}")
-        self.parse_way(file_path)
-        print(f"parse way finished {datetime.now()}")
+        print(f"parse {file_path} start {datetime.now()}")
+        with self.phase("parse_relation"):
+            self.parse_relation(file_path, root_boundary_id, max_admin_level, name_preference)
+        with self.phase("parse_way"):
+            self.parse_way(file_path)
+        self.metrics.gauge("parse.boundary.count", len(self.boundaries))
 
     def parse_relation(self, file_path: str, root_boundary_id: Optional[int] = None, max_admin_level: int = 7, name_preference: Optional[str] = None):
         self.max_admin_level = max_admin_level
         self.root_boundary = root_boundary_id
 
-        self.fetch_relation_from_osm(file_path, name_preference)
+        with self.phase("parse_relation.fetch"):
+            self.fetch_relation_from_osm(file_path, name_preference)
 
         # 为每个 boundary 寻找父节点与根节点
-        self.build_DAG()
+        with self.phase("parse_relation.build_DAG"):
+            self.build_DAG()
 
         # 清除超过行政区划等级的行政边界，注意这里可能会有 admin_level = None 的行政边界，这些边界在目前的逻辑中被删除
-        self.filter_by_admin_level(max_admin_level)
-        
-        self.filter_by_root_boundary(root_boundary_id)
+        with self.phase("parse_relation.filter"):
+            self.filter_by_admin_level(max_admin_level)
+            self.filter_by_root_boundary(root_boundary_id)
 
-        self.fix_missing_relation(name_preference, max_admin_level)
+        with self.phase("parse_relation.fix_missing"):
+            self.fix_missing_relation(name_preference, max_admin_level)
 
     def fetch_relation_from_osm(self, file_path: str, name_preference: Optional[str] = None):
         for obj in osmium.FileProcessor(file_path)\
@@ -78,12 +99,15 @@ class OsmAdminBoundaryParser:
                     
                     boundary = Boundary(osm_id, name, name_en, name_zh, name_preference, admin_level,
                                          subarea_id_list, outer_boundary_id_list, inner_boundary_id_list)
+                    self.metrics.increment("parse.relation.read")
                     if osm_id not in self.boundaries:
                         self.boundaries[osm_id] = boundary
                     else:
                         print(f"boundary {boundary.name}({osm_id}) appears twice")
+                        self.metrics.increment("parse.relation.duplicate")
                 else:
                     self.non_admin_boundary.add(obj.id)
+                    self.metrics.increment("parse.relation.non_admin")
 
     
     def parse_way(self, file_path: str) -> None:
@@ -93,42 +117,85 @@ class OsmAdminBoundaryParser:
             for way in boundary.outer_boundary_id_list:
                 self.way_need.add(way)
         
-        for obj in osmium.FileProcessor(file_path, osmium.osm.NODE | osmium.osm.WAY)\
-            .with_locations()\
-            .with_filter(osmium.filter.EntityFilter(osmium.osm.WAY))\
-            .with_filter(osmium.filter.GeoInterfaceFilter()):
-                 if obj.id in self.way_need:
-                    geom = shape(obj.__geo_interface__['geometry']).simplify(0.0001)
-                    self.ways[obj.id] = Way(obj.id, geom, obj.is_closed())
+        with self.phase("parse_way.read"):
+            for obj in osmium.FileProcessor(file_path, osmium.osm.NODE | osmium.osm.WAY)\
+                .with_locations()\
+                .with_filter(osmium.filter.EntityFilter(osmium.osm.WAY))\
+                .with_filter(osmium.filter.GeoInterfaceFilter()):
+                     if obj.id in self.way_need:
+                        geom = shape(obj.__geo_interface__['geometry']).simplify(0.0001)
+                        self.ways[obj.id] = Way(obj.id, geom, obj.is_closed())
+        self.metrics.increment("parse.way.need", len(self.way_need))
+        self.metrics.increment("parse.way.read", len(self.ways))
+
+        with self.phase("parse_way.fix_missing"):
+            self.fix_missing_way()
+
+        with self.phase("parse_way.polygonize"):
+            count_fail = self.build_boundary_geometry()
+        self.metrics.increment("parse.way.boundary_fail", count_fail)
+        print(f"parse way fail count: {count_fail}")
+
+    def build_boundary_geometry(self) -> int:
+        # 第一轮只使用本地数据修复，记录仍有未闭合端点的 boundary 以及这些端点所在的 way
+        open_way_by_boundary: dict[int, set[int]] = dict()
+        for boundary in self.boundaries.values():
+            open_ways = self.build_single_boundary_geometry(boundary)
+            if open_ways:
+                open_way_by_boundary[boundary.osm_id] = open_ways
 
-        self.fix_missing_way()
+        # 文件中的 way 可能因为区域裁切而被截断，只重新获取端点未闭合的 way 再修复一次
+        if open_way_by_boundary:
+            way_to_refetch: set[int] = set().union(*open_way_by_boundary.values())
+            print(f"refetch {len(way_to_refetch)} ways with open ends for {len(open_way_by_boundary)} boundaries")
+            way_fixed: dict[int, Way] = self.overpass_helper.build_way_dict(list(way_to_refetch))
+            self.ways.update(way_fixed)
+            self.metrics.increment("parse.way.refetched", len(way_fixed))
+            if way_fixed:
+                for osm_id in open_way_by_boundary:
+                    self.build_single_boundary_geometry(self.boundaries[osm_id])
 
+        count_status = Counter(boundary.repair_status for boundary in self.boundaries.values())
+        for status, count in count_status.items():
+            self.metrics.increment(f"parse.repair.{status}", count)
+        print(f"boundary repair status: {dict(count_status)}")
         count_fail = 0
         for boundary in self.boundaries.values():
-            outer_ways = list()
-            inner_ways = list()
-            for way in boundary.outer_boundary_id_list:
-                if way in self.ways:
-                    outer_ways.append(self.ways[way].geom)
-            for way in boundary.inner_boundary_id_list:
-                if way in self.ways:
-                    inner_ways.append(self.ways[way].geom)
-            
-            outer_polygons = list(shapely.get_parts(shapely.polygonize(outer_ways)))
-            inner_polygons = list(shapely.get_parts(shapely.polygonize(inner_ways)))
-            if len(outer_ways) != 0 and len(outer_polygons) == 0 or len(inner_ways) != 0 and len(inner_polygons) == 0:
-                print(f"boundary {boundary.name}({boundary.osm_id}) process fail")
+            if boundary.repair_status in (REPAIR_PARTIAL, REPAIR_FAILED):
+                print(f"boundary {boundary.name}({boundary.osm_id}) process {boundary.repair_status}")
                 count_fail += 1
-            result_polygons = list()
-            for outer in outer_polygons:
-                holes = [inner for inner in inner_polygons if inner.within(outer)]
-                if holes:
-                    processed = shapely.Polygon(outer.exterior, [h.exterior for h in holes])
-                    result_polygons.append(processed)
-                else:
-                    result_polygons.append(outer)
-            boundary.geom = shapely.MultiPolygon(result_polygons)
-        print(f"parse way fail count: {count_fail}")
+        return count_fail
+
+    # 构造单个 boundary 的几何并记录修复状态，返回端点未闭合的 way
+    def build_single_boundary_geometry(self, boundary: Boundary) -> set[int]:
+        outer_ways = [self.ways[way] for way in boundary.outer_boundary_id_list if way in self.ways]
+        inner_ways = [self.ways[way] for way in boundary.inner_boundary_id_list if way in self.ways]
+        outer = polygonize_lines([way.geom for way in outer_ways])
+        inner = polygonize_lines([way.geom for way in inner_ways])
+
+        result_polygons = list()
+        for polygon in outer.polygons:
+            holes = [hole for hole in inner.polygons if hole.within(polygon)]
+            if holes:
+                result_polygons.append(shapely.Polygon(polygon.exterior, [hole.exterior for hole in holes]))
+            else:
+                result_polygons.append(polygon)
+        # 多个外环之间可能重叠或相接，整体不一定是合法的 MultiPolygon
+        geom = shapely.MultiPolygon(result_polygons)
+        status = worst_status(outer.status, inner.status)
+        if not geom.is_valid:
+            geom = shapely.MultiPolygon(polygonal_parts(shapely.make_valid(geom)))
+            status = worst_status(status, REPAIR_MADE_VALID)
+        boundary.geom = geom
+        boundary.repair_status = status
+
+        open_points = outer.open_points | inner.open_points
+        open_ways: set[int] = set()
+        for way in outer_ways + inner_ways:
+            coords = shapely.get_coordinates(way.geom)
+            if len(coords) and (point_key(coords[0]) in open_points or point_key(coords[-1]) in open_points):
+                open_ways.add(way.osm_id)
+        return open_ways
 
     def build_DAG(self):
         count_referenced_by_parent = Counter()
@@ -188,6 +255,8 @@ class OsmAdminBoundaryParser:
         
         relation_tree = self.overpass_helper.build_relation_tree_from_root_relation(name_preference, max_admin_level, relation_to_be_fixed)
         self.boundaries.update(relation_tree)
+        self.metrics.increment("parse.relation.missing", len(relation_to_be_fixed))
+        self.metrics.increment("parse.relation.fixed", len(relation_tree))
         # 填充根节点的 super_area_id_list
         for relation_id in relation_to_be_fixed_with_parent:
             if relation_id in relation_tree:
@@ -218,6 +287,8 @@ class OsmAdminBoundaryParser:
         way_missing: set[int] = self.way_need - set(self.ways.keys())
         way_fixed: dict[int, Way] = self.overpass_helper.build_way_dict(list(way_missing))
         self.ways.update(way_fixed)
+        self.metrics.increment("parse.way.missing", len(way_missing))
+        self.metrics.increment("parse.way.fixed", len(way_fixed))
 
         print(f"way missing: {len(way_missing)}, way fixed: {len(way_fixed)}")
         if len(way_missing) != len(way_fixed):
@@ -251,10 +322,8 @@ class OsmAdminBoundaryParser:
         if os.path.exists(db_path):
             return
         conn = duckdb.connect(db_path)
+        load_spatial_extension(conn, allow_install=True)
         ddl = '''
-        INSTALL spatial;
-        LOAD spatial;
-
         CREATE TABLE IF NOT EXISTS relation (
             osm_id BIGINT PRIMARY KEY,
             name VARCHAR,
@@ -276,12 +345,47 @@ class OsmAdminBoundaryParser:
 
         conn.close()
     
-    def save_to_database(self, overwrite: bool = False, db_path: str = "db/boundary.duckdb") -> None:
-        print(f"save to database start {datetime.now()}")
-        self.save_relation_to_database(overwrite, db_path)
-        print(f"save relation finished {datetime.now()}")
+    # @snapshot_path: 不为 None 时在写入数据库后额外导出供 QueryWorker mmap 加载的 query snapshot。
+    #                 不覆盖时数据库中还有之前保存的 boundary，因此 snapshot 从刚写入的数据库导出
+    def save_to_database(self, overwrite: bool = False, db_path: str = "db/boundary.duckdb",
+                         snapshot_path: Optional[str] = None) -> None:
+        with self.phase("save_relation"):
+            self.save_relation_to_database(overwrite, db_path)
+        if snapshot_path is not None:
+            self.save_query_snapshot(snapshot_path, db_path)
+
+    # @db_path: 从该数据库的 relation 表导出，None 表示导出内存中本次解析的 boundary
+    def save_query_snapshot(self, snapshot_path: str = "db/boundary.snapshot", db_path: Optional[str] = None) -> None:
+        Path(snapshot_path).parent.mkdir(parents=True, exist_ok=True)
+        with self.phase("save_query_snapshot"):
+            boundaries = load_boundaries(db_path) if db_path is not None else self.boundaries
+            count = export_query_snapshot(boundaries, snapshot_path)
+        self.metrics.increment("save.snapshot.boundaries", count)
 
-    def save_relation_to_database(self, overwrite: bool = False, db_path: str = "db/boundary.duckdb") -> None:
+    """
+    把数据写入新的带版本号的数据库（与 snapshot）文件，写完后原子地切换指针文件完成发布，
+    开启了热加载的 QueryWorker 会在后台加载新版本后切换，不需要停止服务。
+    同一个文件不会被写入两次，因此 init_db 总会重新建表，也不会和正在读取旧版本的进程冲突
+    @keep: 保留最近的版本数，更早的版本文件会被删除
+    """
+    def publish_database(self, db_dir: str = "db", name: str = "boundary", snapshot: bool = False,
+                         keep: int = 3) -> DatabaseVersion:
+        version = version_paths(db_dir, name, new_version(), snapshot)
+        with self.phase("save_relation"):
+            self.save_relation_to_database(False, version.db_path)
+        if version.snapshot_path is not None:
+            self.save_query_snapshot(version.snapshot_path)
+        pointer = pointer_path(db_dir, name)
+        publish(pointer, version)
+        prune_versions(pointer, name, keep)
+        self.metrics.increment("save.publish")
+        return version
+
+    # @boundaries: 只写入这部分 boundary，默认写入全部
+    def save_relation_to_database(self, overwrite: bool = False, db_path: str = "db/boundary.duckdb",
+                                  boundaries: Optional[list[Boundary]] = None) -> None:
+        if boundaries is None:
+            boundaries = list(self.boundaries.values())
         self.init_db(db_path)
 
         conn = duckdb.connect(db_path)
@@ -289,13 +393,10 @@ class OsmAdminBoundaryParser:
         if overwrite:
             conn.execute("DELETE FROM relation")
         
-        conn.execute('''
-        INSTALL spatial;
-        LOAD spatial;
-        ''')
-        
+        load_spatial_extension(conn, allow_install=True)
+
         insert_data: list[tuple] = list()
-        for boundary in self.boundaries.values():
+        for boundary in boundaries:
             insert_data.append((
                 boundary.osm_id,
                 boundary.name,
@@ -316,11 +417,84 @@ class OsmAdminBoundaryParser:
             ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ST_GeomFromWKB(?)
         )
         """, insert_data)
+        self.metrics.increment("save.relation.rows", len(insert_data))
 
         conn.execute("create index if not exists idx_geom on relation using RTREE (geom)")
 
         conn.close()
-    
+
+    """
+    按根节点分区保存，每个根节点一个数据库（各自带 RTREE 索引），并写出供 PartitionRouter 使用的分区索引。
+    分区索引记录每个分区的 bbox 与简化后的外轮廓，轮廓先外扩再简化，保证不会漏掉分区内的点。
+    已有的分区索引中不属于本次重建的分区会原样保留，因此可以每次只解析、重建一个国家
+    """
+    def save_partitioned_databases(self, db_dir: str = "db/partitions", snapshot: bool = False,
+                                   outline_tolerance: float = 0.01) -> str:
+        Path(db_dir).mkdir(parents=True, exist_ok=True)
+        partitions: dict[int, list[Boundary]] = dict()
+        for boundary in self.boundaries.values():
+            partitions.setdefault(boundary.root_boundary_id, list()).append(boundary)
+
+        index: list[dict] = list()
+        # 不再导出 snapshot 的分区，旧的分区索引仍然引用旧 snapshot，写出新索引后再删除
+        stale_snapshots: list[str] = list()
+        for root_id, boundaries in partitions.items():
+            geoms = [boundary.geom for boundary in boundaries if boundary.geom is not None and not boundary.geom.is_empty]
+            if not geoms:
+                print(f"partition {root_id} has no geometry, skip")
+                continue
+            root = self.boundaries.get(root_id)
+            # 根节点的几何可能只修复了一部分（repair_status 为 partial），用分区内全部几何的并集作为外轮廓，
+            # 保证落在任一子区域内的点都会被路由到该分区
+            outline = shapely.union_all(geoms)
+            outline = outline.buffer(outline_tolerance).simplify(outline_tolerance)
+            bbox = shapely.GeometryCollection(geoms).bounds
+
+            db_name = f"{root_id}.duckdb"
+            db_path = os.path.join(db_dir, db_name)
+            # 运行中的 PartitionRouter 随时可能打开旧文件，先写入临时文件再原子地替换，
+            # 不会读到不存在、被写锁定或写了一半的数据库。临时文件总是新建，init_db 会重新建表
+            tmp_db_path = f"{db_path}.tmp"
+            for path in (tmp_db_path, f"{tmp_db_path}.wal"):
+                if os.path.exists(path):
+                    os.remove(path)
+            with self.phase(f"save_partition.{root_id}"):
+                self.save_relation_to_database(False, tmp_db_path, boundaries)
+            os.replace(tmp_db_path, db_path)
+            snapshot_name = None
+            snapshot_path = os.path.join(db_dir, f"{root_id}.snapshot")
+            if snapshot:
+                snapshot_name = f"{root_id}.snapshot"
+                export_query_snapshot({boundary.osm_id: boundary for boundary in boundaries}, snapshot_path)
+            elif os.path.exists(snapshot_path):
+                stale_snapshots.append(snapshot_path)
+            index.append({
+                "root_boundary_id": root_id,
+                "name": root.name if root is not None else None,
+                "admin_level": root.admin_level if root is not None else None,
+                "db": db_name,
+                "snapshot": snapshot_name,
+                "boundary_count": len(boundaries),
+                "bbox": list(bbox),
+                "outline": shapely.to_wkb(outline, hex=True),
+            })
+            self.metrics.increment("save.partition.count")
+
+        index_path = os.path.join(db_dir, "partitions.json")
+        rebuilt = {item["root_boundary_id"] for item in index}
+        kept: list[dict] = list()
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                kept = [item for item in json.load(f)["partitions"] if item["root_boundary_id"] not in rebuilt]
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "partitions": kept + index}, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+        for path in stale_snapshots:
+            os.remove(path)
+        print(f"save {len(index)} partitions, keep {len(kept)} existing partitions. index saved as {index_path}")
+        return index_path
+
     def get_super_boundary(self, osm_id: int, super_boundary_max_admin_level: int) -> int:
         pass
 
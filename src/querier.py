@@ -1,22 +1,126 @@
-import duckdb
+import time
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 from duckdb import DuckDBPyConnection
-from overpass_helper import OverpassHelper
+from typing import Callable, Iterable, Optional
+from metrics import MetricsSink
+from model import QueryResult
+from db_version import read_current
+from query_trace import TraceRecorder, read_traces
+from snapshot import QuerySnapshot
+from utils_duckdb import connect, load_spatial_extension
 
-class QueryWorker:
-    def __init__(self, db_path: str = "db/boundary.duckdb",
-                 overpass_endpoint: str = "https://overpass-api.de/api/interpreter"):
+
+class ResultCache:
+    """线程安全的 LRU 结果缓存"""
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        self.items: OrderedDict[tuple, QueryResult] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[QueryResult]:
+        with self.lock:
+            result = self.items.get(key)
+            if result is not None:
+                self.items.move_to_end(key)
+            return result
+
+    def put(self, key: tuple, result: QueryResult) -> None:
+        with self.lock:
+            self.items[key] = result
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def keys(self) -> list[tuple]:
+        """按最近使用在前的顺序返回全部 key"""
+        with self.lock:
+            return list(reversed(self.items))
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+def query_overpass_names(overpass_helper, metrics: MetricsSink, lon: float, lat: float, name_suffix: str,
+                         max_admin_level: int) -> list[str]:
+    metrics.increment("query.overpass.request")
+    start = time.perf_counter()
+    try:
+        raw_result = overpass_helper.get_reverse_geocoding(
+            lon, lat, 'name'+name_suffix.replace('_', ':'))
+    finally:
+        metrics.observe("query.overpass.seconds", time.perf_counter() - start)
+    if not raw_result:
+        return list()
+    raw_result.sort(key=lambda x: x.admin_level)
+    return [item.name_preference for item in raw_result
+            if item.admin_level <= max_admin_level]
+
+
+def local_result(rows: list[tuple[int, int, Optional[str]]]) -> QueryResult:
+    """由按 admin_level 排序的 (admin_level, osm_id, name) 构造本地查询结果"""
+    return QueryResult([row[2] for row in rows], "local", None, [(row[0], row[1]) for row in rows])
+
+
+class DatabaseState:
+    """
+    一个数据库版本在查询进程中的全部状态: 只读连接、query snapshot、吸附索引与结果缓存。
+    查询期间持有引用，被新版本替换后由最后一个进行中的查询负责关闭。
+    有 snapshot 时本地查询、吸附与健康检查都不需要 DuckDB，连接延迟到第一次使用时才打开，启动只需要 mmap snapshot
+    @connect: 打开只读连接的函数
+    """
+    def __init__(self, version: Optional[str], db_path: str, snapshot_path: Optional[str],
+                 connect: Callable[[], DuckDBPyConnection], metrics: MetricsSink, cache_size: int = 0):
+        self.version: Optional[str] = version
         self.db_path: str = db_path
-        self.connection: type[DuckDBPyConnection]
-        self.create_connection()
-        self.overpass_helper = OverpassHelper(overpass_endpoint)
-    
-    def create_connection(self):
-        self.connection = duckdb.connect(self.db_path, read_only=True)
-        self.connection.install_extension('spatial')
-        self.connection.load_extension('spatial')
-        self.check_healthy()
-    
+        self.connect: Callable[[], DuckDBPyConnection] = connect
+        self._connection: Optional[DuckDBPyConnection] = None
+        self.connection_lock = threading.Lock()
+        self.snapshot: Optional[QuerySnapshot] = None
+        if snapshot_path is not None:
+            self.snapshot = QuerySnapshot(snapshot_path)
+        self.metrics: MetricsSink = metrics
+        # 吸附索引需要反序列化全部几何，由 QueryWorker.open_state 在开始服务之前构建
+        self._snap_index = None
+        self.cache: Optional[ResultCache] = ResultCache(cache_size) if cache_size > 0 else None
+        # 进行中的查询数量与是否已被新版本替换，均由 QueryWorker.lock 保护
+        self.refs: int = 0
+        self.retired: bool = False
+
+    @property
+    def connection(self) -> DuckDBPyConnection:
+        if self._connection is None:
+            with self.connection_lock:
+                if self._connection is None:
+                    start = time.perf_counter()
+                    self._connection = self.connect()
+                    self.metrics.observe("query_worker.connect.seconds", time.perf_counter() - start)
+        return self._connection
+
+    @property
+    def snap_index(self):
+        if self._snap_index is None:
+            from snapping import SnapIndex
+            start = time.perf_counter()
+            if self.snapshot is not None:
+                self._snap_index = SnapIndex.from_snapshot(self.snapshot)
+            else:
+                self._snap_index = SnapIndex.from_connection(self.connection)
+            self.metrics.observe("query_worker.snap_index.seconds", time.perf_counter() - start)
+        return self._snap_index
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
     def check_healthy(self) -> bool:
+        if self.snapshot is not None:
+            return self.snapshot.count > 0
         try:
             result = self.connection.execute('select count(1) from relation')
             count = result.fetchone()[0]
@@ -24,37 +128,425 @@ class QueryWorker:
                 return True
         except:
             return False
-    
+
+    def query_local(self, lon: float, lat: float, name_suffix: str, max_admin_level: int) -> QueryResult:
+        if self.snapshot is not None:
+            return local_result(self.snapshot.query_chain(lon, lat, 'name'+name_suffix, max_admin_level))
+        rows = self.connection.execute(
+            (f'select admin_level, osm_id, name{name_suffix} from relation '
+             f'where ST_Contains(geom, ST_Point({lon},{lat})) '
+             f'and admin_level <= {max_admin_level} '
+             'order by admin_level')).fetchall()
+        return local_result(rows)
+
+    def query_local_batch(self, points: list[tuple[float, float]], name_suffix: str,
+                          max_admin_level: int) -> list[QueryResult]:
+        if self.snapshot is not None:
+            return [local_result(self.snapshot.query_chain(lon, lat, 'name'+name_suffix, max_admin_level))
+                    for lon, lat in points]
+        rows_by_point: list[list[tuple]] = [list() for _ in points]
+        if not points:
+            return list()
+        # 多个 unnest 在同一个 select 中会按位置对齐，相当于把点列表作为一张临时表与 relation 做空间 join
+        rows = self.connection.execute(
+            (f'select p.idx, r.admin_level, r.osm_id, r.name{name_suffix} from '
+             '(select unnest(?) as idx, unnest(?) as lon, unnest(?) as lat) p '
+             'join relation r on ST_Contains(r.geom, ST_Point(p.lon, p.lat)) '
+             'where r.admin_level <= ? '
+             'order by p.idx, r.admin_level'),
+            [list(range(len(points))), [float(p[0]) for p in points], [float(p[1]) for p in points],
+             max_admin_level]).fetchall()
+        for idx, admin_level, osm_id, name in rows:
+            rows_by_point[idx].append((admin_level, osm_id, name))
+        return [local_result(point_rows) for point_rows in rows_by_point]
+
+
+class QueryWorker:
+    # @metrics: 查询延迟直方图、各查询路径的耗时与 fallback 计数的输出，默认丢弃
+    # @snapshot_path: 不为 None 时本地查询与吸附改为使用 mmap 加载的 query snapshot，多个进程共享同一份内存
+    #                 此时启动与查询都不会打开 DuckDB
+    # @spatial_extension_path: 本地 spatial.duckdb_extension 文件路径，启动时不会联网安装 extension
+    # @extension_directory: 预先安装好 extension 的目录，与 spatial_extension_path 二选一即可
+    # @snap_distance: 不为 None 时，落在所有边界之外的点会吸附到该距离（米）内最近的边界链，再考虑 overpass fallback
+    # @cache_size: 结果缓存的容量，0 表示不缓存
+    # @cache_precision: 缓存 key 中经纬度保留的小数位数，5 位约为 1 米
+    # @trace_recorder: 不为 None 时按采样率记录查询，用于回放与预热缓存
+    # @version_pointer: OsmAdminBoundaryParser.publish_database 写出的指针文件，不为 None 时忽略 db_path 与 snapshot_path，
+    #                   打开指针指向的版本，并每隔 reload_interval 秒检查一次新版本，在后台预热后无停机切换
+    def __init__(self, db_path: str = "db/boundary.duckdb",
+                 overpass_endpoint: str = "https://overpass-api.de/api/interpreter",
+                 metrics: Optional[MetricsSink] = None,
+                 snapshot_path: Optional[str] = None,
+                 spatial_extension_path: Optional[str] = None,
+                 extension_directory: Optional[str] = None,
+                 snap_distance: Optional[float] = None,
+                 cache_size: int = 0,
+                 cache_precision: int = 5,
+                 trace_recorder: Optional[TraceRecorder] = None,
+                 version_pointer: Optional[str] = None,
+                 reload_interval: float = 10.0):
+        start = time.perf_counter()
+        self.overpass_endpoint: str = overpass_endpoint
+        self.metrics: MetricsSink = metrics if metrics is not None else MetricsSink()
+        self.spatial_extension_path: Optional[str] = spatial_extension_path
+        self.extension_directory: Optional[str] = extension_directory
+        # overpass 客户端只在 fallback 时使用，延迟到第一次 fallback 时再 import 与创建
+        self._overpass_helper = None
+        self.snap_distance: Optional[float] = snap_distance
+        self.cache_size: int = cache_size
+        self.cache_precision: int = cache_precision
+        self.trace_recorder: Optional[TraceRecorder] = trace_recorder
+        self.version_pointer: Optional[str] = version_pointer
+        self.reload_interval: float = reload_interval
+        # 保护 state 的切换与每个 state 的引用计数
+        self.lock = threading.Lock()
+        version = None
+        if version_pointer is not None:
+            current = read_current(version_pointer)
+            if current is None:
+                raise FileNotFoundError(f"no database version published at {version_pointer}")
+            version, db_path, snapshot_path = current
+        self.state: DatabaseState = self.open_state(version, db_path, snapshot_path)
+        self.failed_version: Optional[str] = None
+        self.stopped = threading.Event()
+        self.watcher: Optional[threading.Thread] = None
+        if version_pointer is not None and reload_interval > 0:
+            self.watcher = threading.Thread(target=self.watch_versions, name="db-version-watcher", daemon=True)
+            self.watcher.start()
+        self.startup_seconds: float = time.perf_counter() - start
+        self.metrics.observe("query_worker.startup.seconds", self.startup_seconds)
+        print(f"query worker startup in {self.startup_seconds:.3f}s")
+
+    @property
+    def overpass_helper(self):
+        if self._overpass_helper is None:
+            from overpass_helper import OverpassHelper
+            self._overpass_helper = OverpassHelper(self.overpass_endpoint, metrics=self.metrics)
+        return self._overpass_helper
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.state.version
+
+    @property
+    def db_path(self) -> str:
+        return self.state.db_path
+
+    @property
+    def connection(self) -> DuckDBPyConnection:
+        return self.state.connection
+
+    @property
+    def snapshot(self) -> Optional[QuerySnapshot]:
+        return self.state.snapshot
+
+    @property
+    def cache(self) -> Optional[ResultCache]:
+        return self.state.cache
+
+    @property
+    def snap_index(self):
+        return self.state.snap_index
+
+    def create_connection(self, db_path: str) -> DuckDBPyConnection:
+        connection = connect(db_path, read_only=True, extension_directory=self.extension_directory)
+        load_spatial_extension(connection, self.spatial_extension_path)
+        return connection
+
+    def open_state(self, version: Optional[str], db_path: str, snapshot_path: Optional[str]) -> DatabaseState:
+        state = DatabaseState(version, db_path, snapshot_path, lambda: self.create_connection(db_path),
+                              self.metrics, self.cache_size)
+        state.check_healthy()
+        # 在开始服务之前构建吸附索引，避免第一次未命中时阻塞查询线程
+        if self.snap_distance is not None:
+            try:
+                state.snap_index
+            except:
+                state.close()
+                raise
+        return state
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.join()
+        self.state.close()
+
+    def check_healthy(self) -> bool:
+        with self.use_state() as state:
+            return state.check_healthy()
+
+    """
+    hold the current database state for the duration of a query, so that a version switch
+    in the middle of the query does not close the connection it is using
+    """
+    @contextmanager
+    def use_state(self):
+        with self.lock:
+            state = self.state
+            state.refs += 1
+        try:
+            yield state
+        finally:
+            with self.lock:
+                state.refs -= 1
+                close = state.retired and state.refs == 0
+            if close:
+                state.close()
+
+    def watch_versions(self) -> None:
+        while not self.stopped.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                self.metrics.increment("query_worker.reload.error")
+                print(f"reload database version failed: {e}")
+
+    """
+    switch to the version the pointer file points to, if it is newer than the one in use.
+    the new version is opened and warmed up on the calling thread while queries keep running on the old one,
+    the old version is closed once the last query using it finishes. returns whether a switch happened
+    """
+    def reload(self) -> bool:
+        current = read_current(self.version_pointer)
+        if current is None or current.version in (self.state.version, self.failed_version):
+            return False
+        start = time.perf_counter()
+        print(f"load database version {current.version}")
+        state = None
+        try:
+            state = self.open_state(*current)
+            if not state.check_healthy():
+                raise ValueError(f"database version {current.version} has no boundary")
+            self.warm_state(state)
+        except:
+            # 同一个版本失败后不再重复尝试，等待下一次发布
+            self.failed_version = current.version
+            if state is not None:
+                state.close()
+            raise
+        with self.lock:
+            old, self.state = self.state, state
+            old.retired = True
+            close = old.refs == 0
+        if close:
+            old.close()
+        seconds = time.perf_counter() - start
+        self.metrics.increment("query_worker.reload.count")
+        self.metrics.observe("query_worker.reload.seconds", seconds)
+        print(f"switch from database version {old.version} to {state.version} in {seconds:.3f}s")
+        return True
+
+    """
+    prepare a state that is not serving queries yet: fault in the snapshot pages, run a probe query so that
+    duckdb loads the RTREE index, and re-resolve the keys cached by the serving state.
+    the snap index is already built by open_state
+    """
+    def warm_state(self, state: DatabaseState) -> None:
+        start = time.perf_counter()
+        if state.snapshot is not None:
+            state.snapshot.prefault()
+        state.query_local(0, 0, "", 11)
+        warmed = 0
+        if state.cache is not None and self.state.cache is not None:
+            old_cache = self.state.cache
+            for key in old_cache.keys():
+                lon, lat, name_suffix, max_admin_level, overpass_fallback = key
+                result = state.query_local(lon, lat, name_suffix, max_admin_level)
+                if not result.names:
+                    # 重新预热时不请求 overpass，原来由 overpass 回答且新版本仍未命中的点沿用原来的结果
+                    result = self.query_fallback(state, lon, lat, name_suffix, max_admin_level, False)
+                    old = old_cache.get(key)
+                    if result.source == "miss" and old is not None and old.source == "overpass":
+                        result = old
+                self.cache_put(state, key, result)
+                warmed += 1
+        self.metrics.observe("query_worker.warm.seconds", time.perf_counter() - start)
+        print(f"warm database version {state.version} with {warmed} cached queries in "
+              f"{time.perf_counter() - start:.3f}s")
+
     """
     return reverse geocoding result from top to down in a list
     """
     def query_boundary_name(self, lon: float, lat: float, name_suffix: str = '',
                             max_admin_level: int = 11,
                             overpass_fallback: bool = True) -> list[str]:
-        result: list[str] = list()
-        try:
-            # TODO: only support en/zh now, preference is not record
-            name_suffix = "_"+name_suffix if name_suffix else ""
-            self.connection.execute(
-                (f'select name{name_suffix} from relation '
-                 f'where ST_Contains(geom, ST_Point({lon},{lat})) '
-                 f'and admin_level <= {max_admin_level} '
-                 'order by admin_level'))
-            while True:
-                row = self.connection.fetchone()
-                if not row:
-                    break
-                result.append(row[0])
-            
-            if not result and overpass_fallback:
-                raw_result = self.overpass_helper.get_reverse_geocoding(
-                    lon, lat, 'name'+name_suffix.replace('_', ':'))
-                if not raw_result:
-                    return result
-
-                raw_result.sort(key=lambda x: x.admin_level)
-                return [item.name_preference for item in raw_result 
-                        if item.admin_level <= max_admin_level]
-        except:
-            return list()
+        return self.query_boundary(lon, lat, name_suffix, max_admin_level, overpass_fallback).names
+
+    """
+    same as query_boundary_name, but also reports which path answered the query
+    and, for snapped points, the distance to the boundary in metres
+    """
+    def query_boundary(self, lon: float, lat: float, name_suffix: str = '',
+                       max_admin_level: int = 11,
+                       overpass_fallback: bool = True) -> QueryResult:
+        self.metrics.increment("query.request")
+        start = time.perf_counter()
+        # TODO: only support en/zh now, preference is not record
+        name_suffix = "_"+name_suffix if name_suffix else ""
+        key = self.cache_key(lon, lat, name_suffix, max_admin_level, overpass_fallback)
+        with self.use_state() as state:
+            cached = self.cache_get(state, key)
+            if cached is not None:
+                self.finish_query(lon, lat, name_suffix, max_admin_level, overpass_fallback, cached, start, True)
+                return cached
+            result = QueryResult(list(), "error")
+            try:
+                result = state.query_local(lon, lat, name_suffix, max_admin_level)
+                self.metrics.observe("query.local.seconds", time.perf_counter() - start)
+                if not result.names:
+                    result = self.query_fallback(state, lon, lat, name_suffix, max_admin_level, overpass_fallback)
+            except:
+                result = QueryResult(list(), "error")
+            finally:
+                self.cache_put(state, key, result)
+                self.finish_query(lon, lat, name_suffix, max_admin_level, overpass_fallback, result, start, False)
         return result
+
+    """
+    vectorized version of query_boundary_name, results are in the same order as points.
+    all points are looked up locally in one query, only the misses are snapped or go to overpass one by one.
+    with defer_overpass the points that still need overpass are returned as "miss" without being cached or traced,
+    the caller runs the fallback itself and reports the final result through complete_overpass
+    """
+    def query_boundary_name_batch(self, points: list[tuple[float, float]], name_suffix: str = '',
+                                  max_admin_level: int = 11,
+                                  overpass_fallback: bool = True) -> list[list[str]]:
+        return [result.names for result in
+                self.query_boundary_batch(points, name_suffix, max_admin_level, overpass_fallback)]
+
+    def query_boundary_batch(self, points: list[tuple[float, float]], name_suffix: str = '',
+                             max_admin_level: int = 11,
+                             overpass_fallback: bool = True,
+                             defer_overpass: bool = False) -> list[QueryResult]:
+        self.metrics.increment("query.batch.request")
+        self.metrics.observe("query.batch.size", len(points))
+        start = time.perf_counter()
+        name_suffix = "_"+name_suffix if name_suffix else ""
+        keys = [self.cache_key(lon, lat, name_suffix, max_admin_level, overpass_fallback) for lon, lat in points]
+        with self.use_state() as state:
+            results: list[Optional[QueryResult]] = [self.cache_get(state, key) for key in keys]
+            uncached = [i for i, result in enumerate(results) if result is None]
+            for i, result in enumerate(results):
+                if result is not None:
+                    self.finish_query(*points[i], name_suffix, max_admin_level, overpass_fallback, result, start, True)
+            try:
+                local_results = state.query_local_batch([points[i] for i in uncached], name_suffix, max_admin_level)
+            except:
+                local_results = None
+            self.metrics.observe("query.batch.local.seconds", time.perf_counter() - start)
+
+            for n, i in enumerate(uncached):
+                lon, lat = points[i]
+                if local_results is None:
+                    result = QueryResult(list(), "error")
+                else:
+                    result = local_results[n]
+                if local_results is not None and not result.names:
+                    try:
+                        result = self.query_fallback(state, lon, lat, name_suffix, max_admin_level,
+                                                     overpass_fallback and not defer_overpass)
+                    except:
+                        result = QueryResult(list(), "error")
+                    if defer_overpass and overpass_fallback and result.source == "miss":
+                        results[i] = result
+                        continue
+                self.cache_put(state, keys[i], result)
+                self.finish_query(lon, lat, name_suffix, max_admin_level, overpass_fallback, result, start, False)
+                results[i] = result
+        self.metrics.observe("query.batch.seconds", time.perf_counter() - start)
+        return results
+
+    """
+    cache and trace the final result of a query whose overpass fallback was deferred by query_boundary_batch
+    @start: time.perf_counter() when the caller received the query
+    """
+    def complete_overpass(self, lon: float, lat: float, name_suffix: str, max_admin_level: int,
+                          result: QueryResult, start: float) -> None:
+        name_suffix = "_"+name_suffix if name_suffix else ""
+        with self.use_state() as state:
+            self.cache_put(state, self.cache_key(lon, lat, name_suffix, max_admin_level, True), result)
+        self.finish_query(lon, lat, name_suffix, max_admin_level, True, result, start, False)
+
+    def cache_key(self, lon: float, lat: float, name_suffix: str, max_admin_level: int,
+                  overpass_fallback: bool) -> Optional[tuple]:
+        if self.cache_size <= 0:
+            return None
+        return (round(lon, self.cache_precision), round(lat, self.cache_precision),
+                name_suffix, max_admin_level, overpass_fallback)
+
+    def cache_get(self, state: DatabaseState, key: Optional[tuple]) -> Optional[QueryResult]:
+        if key is None:
+            return None
+        result = state.cache.get(key)
+        self.metrics.increment("query.cache.hit" if result is not None else "query.cache.miss")
+        return result
+
+    def cache_put(self, state: DatabaseState, key: Optional[tuple], result: QueryResult) -> None:
+        # 未命中与出错的结果可能是 overpass 的临时故障，不缓存
+        if key is not None and result.source in ("local", "snap", "overpass"):
+            state.cache.put(key, result)
+
+    def finish_query(self, lon: float, lat: float, name_suffix: str, max_admin_level: int, overpass_fallback: bool,
+                     result: QueryResult, start: float, cached: bool) -> None:
+        latency = time.perf_counter() - start
+        self.metrics.increment(f"query.path.{'cache' if cached else result.source}")
+        self.metrics.observe("query.seconds", latency)
+        if self.trace_recorder is not None:
+            self.trace_recorder.record(lon, lat, name_suffix, max_admin_level, overpass_fallback,
+                                       "cache" if cached else result.source, latency)
+
+    """
+    pre-warm the result cache with the most frequent queries in recorded traces, the same way warm_state does:
+    every query is resolved locally or by snapping, and only those results are cached.
+    overpass is only queried for the remaining points when include_overpass is set, since it goes over the network
+    """
+    def warm_cache(self, trace_paths: Iterable[str], include_overpass: bool = False,
+                   limit: Optional[int] = None) -> int:
+        if self.cache is None:
+            return 0
+        start = time.perf_counter()
+        frequency: Counter = Counter()
+        for record in read_traces(trace_paths):
+            if record.source in ("miss", "error") or (record.source == "overpass" and not include_overpass):
+                continue
+            frequency[(round(record.lon, self.cache_precision), round(record.lat, self.cache_precision),
+                       record.name_suffix, record.max_admin_level, record.overpass_fallback)] += 1
+        limit = min(limit or self.cache.max_size, self.cache.max_size)
+        warmed = 0
+        # 直接查询 state 而不经过 query_boundary，预热流量不记录 trace 与查询指标
+        with self.use_state() as state:
+            for key, _ in frequency.most_common(limit):
+                lon, lat, name_suffix, max_admin_level, overpass_fallback = key
+                try:
+                    result = state.query_local(lon, lat, name_suffix, max_admin_level)
+                    if not result.names:
+                        result = self.query_fallback(state, lon, lat, name_suffix, max_admin_level,
+                                                     overpass_fallback and include_overpass)
+                except Exception as e:
+                    print(f"warm cache query ({lon}, {lat}) failed: {e}")
+                    continue
+                if result.source in ("local", "snap") or (include_overpass and result.source == "overpass"):
+                    self.cache_put(state, key, result)
+                    warmed += 1
+        print(f"warm cache with {warmed} of {len(frequency)} distinct queries in {time.perf_counter() - start:.3f}s")
+        return warmed
+
+    # 本地未命中时依次尝试吸附到附近的边界与 overpass
+    def query_fallback(self, state: DatabaseState, lon: float, lat: float, name_suffix: str, max_admin_level: int,
+                       overpass_fallback: bool) -> QueryResult:
+        if self.snap_distance is not None:
+            start = time.perf_counter()
+            snapped = state.snap_index.nearest_chain(lon, lat, self.snap_distance, 'name'+name_suffix, max_admin_level)
+            self.metrics.observe("query.snap.seconds", time.perf_counter() - start)
+            if snapped is not None:
+                self.metrics.observe("query.snap.distance_meters", snapped[1])
+                return QueryResult(snapped[0], "snap", snapped[1], snapped[2])
+        if overpass_fallback:
+            names = self.query_overpass(lon, lat, name_suffix, max_admin_level)
+            if names:
+                return QueryResult(names, "overpass")
+        return QueryResult(list(), "miss")
+
+    def query_overpass(self, lon: float, lat: float, name_suffix: str, max_admin_level: int) -> list[str]:
+        return query_overpass_names(self.overpass_helper, self.metrics, lon, lat, name_suffix, max_admin_level)
@@ -0,0 +1,184 @@
+"""
+查询 trace 的记录与读取
+
+trace 文件为定长二进制记录，便于低开销地追加写入与快速读取:
+ - 文件头: 8 byte magic `MITTRACE` + uint32 版本号 + uint32 单条记录长度
+ - 记录: timestamp(f64) lon(f64) lat(f64) max_admin_level(i8) overpass_fallback(u8)
+         name_suffix(u8) source(u8) latency(f32)
+"""
+import os
+import time
+import glob
+import fcntl
+import random
+import struct
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+MAGIC = b"MITTRACE"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<dddbBBBf")
+NAME_SUFFIXES = ("", "_en", "_zh", "_preference")
+SOURCES = ("local", "snap", "overpass", "miss", "error", "cache")
+
+
+class TraceRecord(NamedTuple):
+    timestamp: float
+    lon: float
+    lat: float
+    max_admin_level: int
+    overpass_fallback: bool
+    name_suffix: str
+    source: str
+    latency: float
+
+
+class TraceRecorder:
+    """
+    按采样率记录查询，写满 max_file_bytes 后切换到新文件。
+    记录先写入内存缓冲区，攒够 buffer_records 条、距上次落盘超过 flush_interval 秒或调用 flush() 时才落盘，
+    查询路径上只有一次加锁与打包。
+    多个进程可以共用同一个 trace_dir，文件名中带有进程号与随机的实例 id。每次切换文件时清理整个目录，
+    从最旧的文件开始删除，直到全部 trace 文件不超过 max_total_bytes 且都不早于 max_age 秒，
+    已经退出的实例留下的文件也会被清理。正在写入的文件持有共享的 flock，清理时会跳过
+    @max_age: None 表示不按时间清理
+    """
+    def __init__(self, trace_dir: str = "trace", sample_rate: float = 0.01,
+                 max_file_bytes: int = 64 * 1024 * 1024, max_total_bytes: int = 1024 * 1024 * 1024,
+                 max_age: Optional[float] = 7 * 24 * 3600, buffer_records: int = 4096,
+                 flush_interval: float = 10.0):
+        self.trace_dir: str = trace_dir
+        self.sample_rate: float = sample_rate
+        self.max_file_bytes: int = max_file_bytes
+        self.max_total_bytes: int = max_total_bytes
+        self.max_age: Optional[float] = max_age
+        self.buffer_records: int = buffer_records
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.buffered: int = 0
+        self.file = None
+        self.file_bytes: int = 0
+        self.sequence: int = 0
+        self.instance: str = f"{os.getpid()}-{os.urandom(4).hex()}"
+        Path(trace_dir).mkdir(parents=True, exist_ok=True)
+        self.stopped = threading.Event()
+        self.flusher: Optional[threading.Thread] = None
+        if flush_interval > 0:
+            self.flusher = threading.Thread(target=self.flush_periodically, args=(flush_interval,),
+                                            name="trace-flusher", daemon=True)
+            self.flusher.start()
+
+    def flush_periodically(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            self.flush()
+
+    def record(self, lon: float, lat: float, name_suffix: str, max_admin_level: int, overpass_fallback: bool,
+               source: str, latency: float) -> None:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        data = RECORD.pack(time.time(), lon, lat, max(-128, min(127, max_admin_level)), overpass_fallback,
+                           NAME_SUFFIXES.index(name_suffix) if name_suffix in NAME_SUFFIXES else 0,
+                           SOURCES.index(source) if source in SOURCES else SOURCES.index("error"), latency)
+        with self.lock:
+            self.buffer += data
+            self.buffered += 1
+            if self.buffered >= self.buffer_records:
+                self._flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self.buffer:
+            return
+        if self.file is None or self.file_bytes >= self.max_file_bytes:
+            self._rotate()
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.file_bytes += len(self.buffer)
+        self.buffer = bytearray()
+        self.buffered = 0
+
+    def _rotate(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.sequence += 1
+        path = os.path.join(self.trace_dir, f"trace-{datetime.now().strftime('%Y%m%d-%H%M%S')}-"
+                                            f"{self.instance}-{self.sequence:04d}.bin")
+        # 独占创建，即使文件名冲突也不会截断其他进程的文件
+        self.file = open(path, "xb")
+        # 写入期间一直持有共享锁，其他实例清理目录时不会删除该文件
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_SH)
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.file_bytes = HEADER.size
+        prune_trace_dir(self.trace_dir, self.max_total_bytes, self.max_age)
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def prune_trace_dir(trace_dir: str, max_total_bytes: int, max_age: Optional[float] = None) -> list[str]:
+    """从最旧的文件开始删除 trace 文件，直到总大小不超过 max_total_bytes 且没有早于 max_age 秒的文件，返回删除的文件"""
+    files: list[tuple[float, int, str]] = list()
+    for path in glob.glob(os.path.join(trace_dir, "trace-*.bin")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    now = time.time()
+    removed: list[str] = list()
+    for mtime, size, path in files:
+        if total <= max_total_bytes and (max_age is None or now - mtime <= max_age):
+            break
+        try:
+            with open(path, "rb") as f:
+                # 拿不到排他锁说明仍有实例在写入该文件
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+        except (BlockingIOError, FileNotFoundError):
+            continue
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def list_trace_files(path: str) -> list[str]:
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "trace-*.bin")))
+    return [path]
+
+
+def read_trace_file(path: str) -> Iterator[TraceRecord]:
+    with open(path, "rb") as f:
+        magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a version {VERSION} trace file")
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            if not chunk:
+                break
+            # 进程异常退出时最后一条记录可能不完整，直接丢弃
+            usable = len(chunk) - len(chunk) % RECORD.size
+            for timestamp, lon, lat, max_admin_level, fallback, suffix, source, latency in RECORD.iter_unpack(chunk[:usable]):
+                yield TraceRecord(timestamp, lon, lat, max_admin_level, bool(fallback),
+                                  NAME_SUFFIXES[suffix], SOURCES[source], latency)
+
+
+def read_traces(paths: Iterable[str]) -> Iterator[TraceRecord]:
+    for path in paths:
+        for trace_file in list_trace_files(path):
+            yield from read_trace_file(trace_file)
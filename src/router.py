@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import shapely
+from shapely import STRtree
+from collections import Counter, OrderedDict
+from typing import Iterable, NamedTuple, Optional
+from metrics import MetricsSink
+from model import QueryResult
+from querier import QueryWorker, query_overpass_names
+from query_trace import read_traces
+
+
+class Partition(NamedTuple):
+    root_boundary_id: int
+    name: Optional[str]
+    admin_level: Optional[int]
+    db_path: str
+    snapshot_path: Optional[str]
+    bbox: tuple[float, float, float, float]
+    outline: any
+
+
+class PartitionRouter:
+    """
+    根据 OsmAdminBoundaryParser.save_partitioned_databases 写出的分区索引，
+    将查询点路由到外轮廓包含该点的分区，每个分区由各自的 QueryWorker 按需打开。
+    接口与 QueryWorker 保持一致，可以直接替换 QueryWorker 使用。
+
+    @regions: 只服务这些根节点对应的分区，None 表示全部分区
+    @max_open: 同时保持打开的分区数量上限，超过时关闭最久未使用的分区
+    @worker_options: 透传给每个分区 QueryWorker 的参数（snap_distance、cache_size 等）
+    """
+    def __init__(self, index_path: str = "db/partitions/partitions.json",
+                 overpass_endpoint: str = "https://overpass-api.de/api/interpreter",
+                 metrics: Optional[MetricsSink] = None, regions: Optional[list[int]] = None,
+                 max_open: int = 8, **worker_options):
+        self.index_path: str = index_path
+        self.overpass_endpoint: str = overpass_endpoint
+        self.metrics: MetricsSink = metrics if metrics is not None else MetricsSink()
+        self.max_open: int = max_open
+        self.worker_options: dict = worker_options
+        self.workers: OrderedDict[int, QueryWorker] = OrderedDict()
+        self._overpass_helper = None
+
+        with open(index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        base_dir = os.path.dirname(index_path)
+        wanted = set(regions) if regions is not None else None
+        self.partitions: list[Partition] = list()
+        for item in index["partitions"]:
+            if wanted is not None and item["root_boundary_id"] not in wanted:
+                continue
+            outline = shapely.from_wkb(item["outline"])
+            shapely.prepare(outline)
+            self.partitions.append(Partition(
+                item["root_boundary_id"], item["name"], item["admin_level"],
+                os.path.join(base_dir, item["db"]),
+                os.path.join(base_dir, item["snapshot"]) if item.get("snapshot") else None,
+                tuple(item["bbox"]), outline))
+        # 根节点等级小的分区（更上层）排在前面，合并多个分区的结果时保持自顶向下的顺序
+        self.partitions.sort(key=lambda x: x.admin_level if x.admin_level is not None else 127)
+        self.tree = STRtree([partition.outline for partition in self.partitions])
+        print(f"partition router loaded {len(self.partitions)} partitions from {index_path}")
+
+    @property
+    def overpass_helper(self):
+        if self._overpass_helper is None:
+            from overpass_helper import OverpassHelper
+            self._overpass_helper = OverpassHelper(self.overpass_endpoint, metrics=self.metrics)
+        return self._overpass_helper
+
+    def route(self, lon: float, lat: float) -> list[Partition]:
+        hits = self.tree.query(shapely.Point(lon, lat), predicate="intersects")
+        return [self.partitions[i] for i in sorted(hits)]
+
+    def worker(self, partition: Partition) -> QueryWorker:
+        worker = self.workers.get(partition.root_boundary_id)
+        if worker is not None:
+            self.workers.move_to_end(partition.root_boundary_id)
+            return worker
+        start = time.perf_counter()
+        worker = QueryWorker(partition.db_path, self.overpass_endpoint, self.metrics,
+                             snapshot_path=partition.snapshot_path, **self.worker_options)
+        self.metrics.observe("router.partition_open.seconds", time.perf_counter() - start)
+        self.workers[partition.root_boundary_id] = worker
+        while len(self.workers) > self.max_open:
+            _, evicted = self.workers.popitem(last=False)
+            evicted.close()
+            self.metrics.increment("router.partition_evicted")
+        return worker
+
+    def check_healthy(self) -> bool:
+        return len(self.partitions) > 0 and all(os.path.exists(partition.snapshot_path or partition.db_path)
+                                                for partition in self.partitions)
+
+    def close(self) -> None:
+        for worker in self.workers.values():
+            worker.close()
+        self.workers.clear()
+
+    def query_boundary_name(self, lon: float, lat: float, name_suffix: str = '',
+                            max_admin_level: int = 11,
+                            overpass_fallback: bool = True) -> list[str]:
+        return self.query_boundary(lon, lat, name_suffix, max_admin_level, overpass_fallback).names
+
+    def query_boundary(self, lon: float, lat: float, name_suffix: str = '',
+                       max_admin_level: int = 11,
+                       overpass_fallback: bool = True) -> QueryResult:
+        partitions = self.route(lon, lat)
+        self.metrics.observe("router.partitions_per_query", len(partitions))
+        results = [self.worker(partition).query_boundary(lon, lat, name_suffix, max_admin_level, False)
+                   for partition in partitions]
+        return self.merge(lon, lat, name_suffix, max_admin_level, overpass_fallback, results)
+
+    def query_boundary_name_batch(self, points: list[tuple[float, float]], name_suffix: str = '',
+                                  max_admin_level: int = 11,
+                                  overpass_fallback: bool = True) -> list[list[str]]:
+        return [result.names for result in
+                self.query_boundary_batch(points, name_suffix, max_admin_level, overpass_fallback)]
+
+    def query_boundary_batch(self, points: list[tuple[float, float]], name_suffix: str = '',
+                             max_admin_level: int = 11,
+                             overpass_fallback: bool = True,
+                             defer_overpass: bool = False) -> list[QueryResult]:
+        # 按分区分组后每个分区只执行一次批量查询
+        point_partitions = [self.route(lon, lat) for lon, lat in points]
+        grouped: dict[int, list[int]] = dict()
+        for i, partitions in enumerate(point_partitions):
+            for partition in partitions:
+                grouped.setdefault(partition.root_boundary_id, list()).append(i)
+        by_id = {partition.root_boundary_id: partition for partition in self.partitions}
+        partial: dict[tuple[int, int], QueryResult] = dict()
+        for root_id, indices in grouped.items():
+            batch = self.worker(by_id[root_id]).query_boundary_batch(
+                [points[i] for i in indices], name_suffix, max_admin_level, False)
+            for i, result in zip(indices, batch):
+                partial[(i, root_id)] = result
+        return [self.merge(lon, lat, name_suffix, max_admin_level, overpass_fallback and not defer_overpass,
+                           [partial[(i, partition.root_boundary_id)] for partition in point_partitions[i]])
+                for i, (lon, lat) in enumerate(points)]
+
+    def merge(self, lon: float, lat: float, name_suffix: str, max_admin_level: int, overpass_fallback: bool,
+              results: list[QueryResult]) -> QueryResult:
+        # 按 (admin_level, osm_id) 合并，同一个 boundary 出现在多个分区时只保留一次，
+        # 名称可以重复或为 None（缺少翻译），不能用名称去重
+        merged: dict[tuple[int, int], Optional[str]] = dict()
+        source, distance = "miss", None
+        for result in results:
+            if not result.names:
+                continue
+            for key, name in zip(result.chain or list(), result.names):
+                merged.setdefault(key, name)
+            # 只要有一个分区本地命中就认为是本地结果，否则沿用距离最近的吸附结果
+            if result.source == "local":
+                source, distance = "local", None
+            elif source != "local" and (distance is None or result.distance < distance):
+                source, distance = result.source, result.distance
+        if merged:
+            chain = sorted(merged)
+            return QueryResult([merged[key] for key in chain], source, distance, chain)
+        if any(result.source == "error" for result in results):
+            return QueryResult(list(), "error")
+        if overpass_fallback:
+            overpass_names = self.query_overpass(lon, lat, "_"+name_suffix if name_suffix else "", max_admin_level)
+            if overpass_names:
+                return QueryResult(overpass_names, "overpass")
+        return QueryResult(list(), "miss")
+
+    """
+    pre-warm the result caches of the partitions with the most frequent queries in recorded traces,
+    see QueryWorker.warm_cache. partitions are opened as the queries are routed, so at most max_open stay warm
+    """
+    def warm_cache(self, trace_paths: Iterable[str], limit: Optional[int] = None) -> int:
+        cache_size = self.worker_options.get("cache_size", 0)
+        if cache_size <= 0:
+            return 0
+        start = time.perf_counter()
+        frequency: Counter = Counter()
+        for record in read_traces(trace_paths):
+            # 分区 worker 记录的 trace 不包含 overpass 结果，路由层的 fallback 不需要预热
+            if record.source in ("miss", "error", "overpass"):
+                continue
+            frequency[(record.lon, record.lat, record.name_suffix, record.max_admin_level)] += 1
+        # 预热时不记录 trace，避免预热流量污染线上的查询分布
+        trace_recorder = self.worker_options.pop("trace_recorder", None)
+        for worker in self.workers.values():
+            worker.trace_recorder = None
+        try:
+            for (lon, lat, name_suffix, max_admin_level), _ in frequency.most_common(limit or cache_size):
+                self.query_boundary(lon, lat, name_suffix.lstrip('_'), max_admin_level, False)
+        finally:
+            self.worker_options["trace_recorder"] = trace_recorder
+            for worker in self.workers.values():
+                worker.trace_recorder = trace_recorder
+        warmed = min(limit or cache_size, len(frequency))
+        print(f"warm partition caches with {warmed} of {len(frequency)} distinct queries in "
+              f"{time.perf_counter() - start:.3f}s")
+        return warmed
+
+    def complete_overpass(self, lon: float, lat: float, name_suffix: str, max_admin_level: int,
+                          result: QueryResult, start: float) -> None:
+        # 各分区的 worker 只缓存与记录各自的本地结果，路由层没有自己的缓存与 trace
+        self.metrics.increment(f"router.fallback.{result.source}")
+
+    def query_overpass(self, lon: float, lat: float, name_suffix: str, max_admin_level: int) -> list[str]:
+        return query_overpass_names(self.overpass_helper, self.metrics, lon, lat, name_suffix, max_admin_level)
@@ -0,0 +1,395 @@
+"""
+基于 asyncio 的 reverse geocoding HTTP 服务
+
+接口:
+ - GET  /reverse?lon=&lat=[&lang=en|zh][&max_admin_level=11][&fallback=1]
+ - POST /reverse/batch[?lang=&max_admin_level=&fallback=]  请求体为 NDJSON 或 JSON 数组，
+   每个元素为 {"lon": .., "lat": ..} 或 [lon, lat]，返回 chunked NDJSON，按请求顺序逐块输出
+ - GET  /health
+ - GET  /metrics  (仅当使用 InMemoryMetrics 时)
+
+并发的单点请求在一个很短的时间窗口内被合并成一次批量查询，
+所有本地查询都在同一个线程中执行（DuckDB 连接不是线程安全的），overpass fallback 在独立的线程池中执行。
+
+用法:
+  python server.py --db db/boundary.duckdb [--snapshot db/boundary.snapshot] [--port 8080]
+  python server.py --db-pointer db/boundary.current [--reload-interval 10]
+ 使用 --db-pointer 时服务 OsmAdminBoundaryParser.publish_database 发布的版本，新版本发布后在后台预热并无停机切换
+"""
+import json
+import time
+import signal
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+from metrics import InMemoryMetrics, MetricsSink
+from model import QueryResult
+from querier import QueryWorker
+from router import PartitionRouter
+from query_trace import TraceRecorder
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 256 * 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+def in_range(lon: float, lat: float) -> bool:
+    # NaN 与任何数比较都为 False，也会被拒绝
+    return -180 <= lon <= 180 and -90 <= lat <= 90
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class StreamAborted(Exception):
+    """chunked 响应头已经发出后查询失败，此时不能再写入新的响应，只能断开连接"""
+
+
+class MicroBatcher:
+    """
+    将同一参数下的并发单点查询合并为一次 query_boundary_batch 调用。
+    @window: 第一个请求到达后最多等待的秒数
+    @max_batch: 攒够该数量的请求后立即执行，不再等待
+    """
+    def __init__(self, worker: QueryWorker, window: float = 0.002, max_batch: int = 256,
+                 fallback_threads: int = 8):
+        self.worker = worker
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics: MetricsSink = worker.metrics
+        # 本地查询只使用一个线程，保证 DuckDB 连接不会被并发访问
+        self.local_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-query")
+        self.fallback_executor = ThreadPoolExecutor(max_workers=fallback_threads, thread_name_prefix="overpass")
+        self.pending: dict[tuple, list[tuple[float, float, asyncio.Future]]] = dict()
+        self.timers: dict[tuple, asyncio.TimerHandle] = dict()
+
+    async def submit(self, lon: float, lat: float, name_suffix: str = '', max_admin_level: int = 11,
+                     overpass_fallback: bool = True) -> QueryResult:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        key = (name_suffix, max_admin_level, overpass_fallback)
+        future = loop.create_future()
+        self.pending.setdefault(key, list()).append((lon, lat, future))
+        if len(self.pending[key]) >= self.max_batch:
+            self.flush(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.window, self.flush, key)
+        result = await future
+        if overpass_fallback and result.source == "miss":
+            result = await self.fallback(lon, lat, name_suffix, max_admin_level, start)
+        return result
+
+    def flush(self, key: tuple) -> None:
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        items = self.pending.pop(key, list())
+        if not items:
+            return
+        self.metrics.observe("server.micro_batch.size", len(items))
+        points = [(lon, lat) for lon, lat, _ in items]
+        # overpass 在独立的线程池中执行，不占用本地查询线程，由 worker 把这些点留给调用方处理
+        task = asyncio.get_running_loop().run_in_executor(
+            self.local_executor, self.worker.query_boundary_batch, points, *key, True)
+
+        def dispatch(done: asyncio.Future) -> None:
+            if done.exception() is not None:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(done.exception())
+                return
+            for (_, _, future), result in zip(items, done.result()):
+                if not future.done():
+                    future.set_result(result)
+        task.add_done_callback(dispatch)
+
+    async def query_batch(self, points: list[tuple[float, float]], name_suffix: str = '',
+                          max_admin_level: int = 11, overpass_fallback: bool = True) -> list[QueryResult]:
+        start = time.perf_counter()
+        results = await asyncio.get_running_loop().run_in_executor(
+            self.local_executor, self.worker.query_boundary_batch, points, name_suffix, max_admin_level,
+            overpass_fallback, True)
+        if overpass_fallback:
+            misses = [i for i, result in enumerate(results) if result.source == "miss"]
+            fallback = await asyncio.gather(*[self.fallback(*points[i], name_suffix, max_admin_level, start)
+                                              for i in misses])
+            for i, result in zip(misses, fallback):
+                results[i] = result
+        return results
+
+    async def fallback(self, lon: float, lat: float, name_suffix: str, max_admin_level: int,
+                       start: float) -> QueryResult:
+        result = await self.query_overpass(lon, lat, name_suffix, max_admin_level)
+        # 最终结果交还给 worker 缓存并记录 trace，与 worker 自己执行 fallback 时的记录一致
+        self.worker.complete_overpass(lon, lat, name_suffix, max_admin_level, result, start)
+        return result
+
+    async def query_overpass(self, lon: float, lat: float, name_suffix: str, max_admin_level: int) -> QueryResult:
+        suffix = "_"+name_suffix if name_suffix else ""
+        try:
+            names = await asyncio.get_running_loop().run_in_executor(
+                self.fallback_executor, self.worker.query_overpass, lon, lat, suffix, max_admin_level)
+            return QueryResult(names, "overpass") if names else QueryResult(list(), "miss")
+        except Exception:
+            self.metrics.increment("server.overpass.error")
+            return QueryResult(list(), "error")
+
+    def close(self) -> None:
+        self.local_executor.shutdown(wait=True)
+        self.fallback_executor.shutdown(wait=False)
+
+
+class ReverseGeocodingServer:
+    def __init__(self, worker: QueryWorker, window: float = 0.002, max_batch: int = 256,
+                 stream_chunk_size: int = 1024, keep_alive_timeout: float = 30.0):
+        self.worker = worker
+        self.batcher = MicroBatcher(worker, window, max_batch)
+        self.stream_chunk_size = stream_chunk_size
+        self.keep_alive_timeout = keep_alive_timeout
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keep_alive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.write_json(writer, 413, {"error": "header too large"}, False)
+                    break
+                try:
+                    method, target, version, headers = self.parse_head(head)
+                except HttpError as e:
+                    await self.write_json(writer, e.status, {"error": e.message}, False)
+                    break
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                try:
+                    body = await self.read_body(reader, method, headers)
+                    await self.route(writer, method, target, body, keep_alive)
+                except HttpError as e:
+                    await self.write_json(writer, e.status, {"error": e.message}, keep_alive)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except StreamAborted:
+                    # 不写结束块，客户端可以据此判断响应不完整
+                    break
+                except Exception as e:
+                    self.worker.metrics.increment("server.error")
+                    await self.write_json(writer, 500, {"error": str(e)}, False)
+                    break
+        finally:
+            writer.close()
+
+    def parse_head(self, head: bytes) -> tuple[str, str, str, dict[str, str]]:
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3:
+            raise HttpError(400, "malformed request line")
+        headers: dict[str, str] = dict()
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1], parts[2], headers
+
+    async def read_body(self, reader: asyncio.StreamReader, method: str, headers: dict[str, str]) -> bytes:
+        if "content-length" not in headers:
+            if method == "POST":
+                raise HttpError(411, "content-length required")
+            return b""
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            raise HttpError(400, "invalid content-length")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "body too large")
+        return await reader.readexactly(length)
+
+    async def route(self, writer: asyncio.StreamWriter, method: str, target: str, body: bytes,
+                    keep_alive: bool) -> None:
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/health":
+            # 健康检查同样会访问 DuckDB 连接，必须在本地查询线程中执行
+            healthy = await asyncio.get_running_loop().run_in_executor(
+                self.batcher.local_executor, self.worker.check_healthy)
+            await self.write_json(writer, 200 if healthy else 500,
+                                  {"healthy": bool(healthy), "version": getattr(self.worker, "version", None)},
+                                  keep_alive)
+        elif url.path == "/metrics":
+            metrics = self.worker.metrics
+            if not isinstance(metrics, InMemoryMetrics):
+                raise HttpError(404, "metrics are not collected in memory")
+            await self.write_json(writer, 200, metrics.snapshot(), keep_alive)
+        elif url.path == "/reverse":
+            if method != "GET":
+                raise HttpError(405, "use GET")
+            lon, lat = self.parse_point(params)
+            self.worker.metrics.increment("server.reverse.request")
+            result = await self.batcher.submit(lon, lat, *self.parse_options(params))
+            await self.write_json(writer, 200, self.result_payload(lon, lat, result), keep_alive)
+        elif url.path == "/reverse/batch":
+            if method != "POST":
+                raise HttpError(405, "use POST")
+            points = self.parse_points(body)
+            self.worker.metrics.increment("server.batch.request")
+            await self.stream_batch(writer, points, self.parse_options(params), keep_alive)
+        else:
+            raise HttpError(404, f"no route for {url.path}")
+
+    def parse_point(self, params: dict[str, str]) -> tuple[float, float]:
+        try:
+            lon, lat = float(params["lon"]), float(params["lat"])
+        except (KeyError, ValueError):
+            raise HttpError(400, "lon and lat are required numbers")
+        if not in_range(lon, lat):
+            raise HttpError(400, "lon/lat out of range")
+        return lon, lat
+
+    def parse_options(self, params: dict[str, str]) -> tuple[str, int, bool]:
+        name_suffix = params.get("lang", "")
+        if name_suffix not in ("", "en", "zh", "preference"):
+            raise HttpError(400, f"unsupported lang: {name_suffix}")
+        try:
+            max_admin_level = int(params.get("max_admin_level", 11))
+        except ValueError:
+            raise HttpError(400, "max_admin_level must be an integer")
+        overpass_fallback = params.get("fallback", "1").lower() not in ("0", "false", "no")
+        return name_suffix, max_admin_level, overpass_fallback
+
+    def parse_points(self, body: bytes) -> list[tuple[float, float]]:
+        try:
+            text = body.decode("utf-8").strip()
+            items = None
+            if text.startswith("["):
+                try:
+                    items = json.loads(text)
+                except ValueError:
+                    pass
+                # 单行 NDJSON 的 [lon, lat] 也是合法的 JSON 数组
+                if items and not isinstance(items[0], (list, dict)):
+                    items = [items]
+            if items is None:
+                items = [json.loads(line) for line in text.splitlines() if line.strip()]
+            points: list[tuple[float, float]] = list()
+            for item in items:
+                if isinstance(item, dict):
+                    points.append((float(item["lon"]), float(item["lat"])))
+                else:
+                    points.append((float(item[0]), float(item[1])))
+        except (ValueError, KeyError, IndexError, TypeError):
+            raise HttpError(400, "body must be NDJSON or a JSON array of points")
+        for i, (lon, lat) in enumerate(points):
+            if not in_range(lon, lat):
+                raise HttpError(400, f"lon/lat of point {i} out of range")
+        return points
+
+    async def stream_batch(self, writer: asyncio.StreamWriter, points: list[tuple[float, float]],
+                           options: tuple[str, int, bool], keep_alive: bool) -> None:
+        writer.write(self.response_head(200, "application/x-ndjson", None, keep_alive))
+        for start in range(0, len(points), self.stream_chunk_size):
+            chunk = points[start:start + self.stream_chunk_size]
+            try:
+                results = await self.batcher.query_batch(chunk, *options)
+            except Exception as e:
+                self.worker.metrics.increment("server.stream.aborted")
+                raise StreamAborted() from e
+            lines = "".join(json.dumps(self.result_payload(lon, lat, result), ensure_ascii=False) + "\n"
+                            for (lon, lat), result in zip(chunk, results)).encode("utf-8")
+            writer.write(f"{len(lines):x}\r\n".encode("latin-1") + lines + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def result_payload(self, lon: float, lat: float, result: QueryResult) -> dict:
+        payload = {"lon": lon, "lat": lat, "names": result.names, "source": result.source}
+        if result.distance is not None:
+            payload["distance"] = round(result.distance, 2)
+        return payload
+
+    def response_head(self, status: int, content_type: str, length: Optional[int], keep_alive: bool) -> bytes:
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                f"Content-Type: {content_type}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        head.append(f"Content-Length: {length}" if length is not None else "Transfer-Encoding: chunked")
+        return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1")
+
+    async def write_json(self, writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(self.response_head(status, "application/json; charset=utf-8", len(body), keep_alive) + body)
+        await writer.drain()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        print(f"serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.batcher.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="reverse geocoding http service")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument("--db", default="db/boundary.duckdb")
+    arg_parser.add_argument("--db-pointer", default=None,
+                            help="version pointer written by publish_database, enables hot reload")
+    arg_parser.add_argument("--reload-interval", type=float, default=10.0,
+                            help="seconds between checks for a newly published version, 0 disables reload")
+    arg_parser.add_argument("--partitions", default=None, help="partition index written by save_partitioned_databases")
+    arg_parser.add_argument("--regions", default="", help="comma separated root boundary ids to serve from --partitions")
+    arg_parser.add_argument("--snapshot", default=None, help="query snapshot exported by the parser")
+    arg_parser.add_argument("--spatial-extension", default=None, help="local spatial.duckdb_extension file")
+    arg_parser.add_argument("--batch-window-ms", type=float, default=2.0)
+    arg_parser.add_argument("--max-batch", type=int, default=256)
+    arg_parser.add_argument("--snap-distance", type=float, default=None,
+                            help="snap points outside every boundary to the nearest one within this many metres")
+    arg_parser.add_argument("--cache-size", type=int, default=0, help="result cache entries, 0 disables the cache")
+    arg_parser.add_argument("--warm-trace", nargs="*", default=[], help="trace files or directories to warm the cache")
+    arg_parser.add_argument("--trace-dir", default=None, help="record sampled queries into this directory")
+    arg_parser.add_argument("--trace-sample-rate", type=float, default=0.01)
+    args = arg_parser.parse_args()
+
+    trace_recorder = TraceRecorder(args.trace_dir, args.trace_sample_rate) if args.trace_dir else None
+    if args.partitions is not None:
+        regions = [int(x) for x in args.regions.split(",") if x.strip()] or None
+        worker = PartitionRouter(args.partitions, metrics=InMemoryMetrics(), regions=regions,
+                                 spatial_extension_path=args.spatial_extension, snap_distance=args.snap_distance,
+                                 cache_size=args.cache_size, trace_recorder=trace_recorder)
+    else:
+        worker = QueryWorker(args.db, metrics=InMemoryMetrics(), snapshot_path=args.snapshot,
+                             spatial_extension_path=args.spatial_extension, snap_distance=args.snap_distance,
+                             cache_size=args.cache_size, trace_recorder=trace_recorder,
+                             version_pointer=args.db_pointer, reload_interval=args.reload_interval)
+    if args.warm_trace:
+        worker.warm_cache(args.warm_trace)
+    server = ReverseGeocodingServer(worker, args.batch_window_ms / 1000, args.max_batch)
+
+    # 容器被编排系统停止时收到的是 SIGTERM，按 Ctrl-C 处理，保证下面的清理会执行、trace 会落盘
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+        if trace_recorder is not None:
+            trace_recorder.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import math
+import numpy as np
+import shapely
+from shapely import STRtree
+from duckdb import DuckDBPyConnection
+from typing import NamedTuple, Optional
+
+NAME_COLUMNS = ("name", "name_en", "name_zh", "name_preference")
+METERS_PER_DEGREE = 111320.0
+
+
+class SnapBoundary(NamedTuple):
+    osm_id: int
+    admin_level: int
+    super_area_id_list: list[int]
+    names: dict[str, Optional[str]]
+    geom: any
+
+
+class SnapIndex:
+    """
+    为落在边界外（海滩、码头、港口等被简化掉的区域）的点寻找最近的边界链。
+    每个 admin_level 各建一棵 STRtree，从最细的级别开始寻找距离阈值内最近的边界，
+    命中后沿 super_area_id_list 向上补全祖先，保证返回的链在层级上是一致的。
+    """
+    def __init__(self, boundaries: list[SnapBoundary]):
+        self.boundaries: dict[int, SnapBoundary] = {boundary.osm_id: boundary for boundary in boundaries}
+        self.trees: dict[int, tuple[STRtree, list[SnapBoundary]]] = dict()
+        by_level: dict[int, list[SnapBoundary]] = dict()
+        for boundary in boundaries:
+            by_level.setdefault(boundary.admin_level, list()).append(boundary)
+        for admin_level, items in by_level.items():
+            self.trees[admin_level] = (STRtree([item.geom for item in items]), items)
+        self.admin_levels: list[int] = sorted(self.trees, reverse=True)
+
+    @classmethod
+    def from_connection(cls, connection: DuckDBPyConnection) -> "SnapIndex":
+        rows = connection.execute(
+            f'select osm_id, admin_level, super_area_id_list, {", ".join(NAME_COLUMNS)}, ST_AsWKB(geom) '
+            'from relation where geom is not null and admin_level is not null').fetchall()
+        boundaries: list[SnapBoundary] = list()
+        for row in rows:
+            geom = shapely.from_wkb(bytes(row[-1]))
+            if geom.is_empty:
+                continue
+            shapely.prepare(geom)
+            names = dict(zip(NAME_COLUMNS, row[3:3 + len(NAME_COLUMNS)]))
+            boundaries.append(SnapBoundary(row[0], row[1], list(row[2] or []), names, geom))
+        print(f"build snap index with {len(boundaries)} boundaries")
+        return cls(boundaries)
+
+    @classmethod
+    def from_snapshot(cls, snapshot) -> "SnapIndex":
+        """
+        直接由 query snapshot 中打包的环构建，不需要打开 DuckDB。
+        每个 boundary 的几何为其全部环组成的 MultiLineString: 只有落在所有候选边界之外的点才会吸附，
+        此时点到多边形的距离就是点到其边界环的距离
+        """
+        from snapshot import NULL_ADMIN_LEVEL
+
+        if snapshot.count == 0:
+            return cls(list())
+        ring_index = np.repeat(np.arange(len(snapshot.ring_offsets) - 1), np.diff(snapshot.ring_offsets))
+        rings = shapely.linestrings(snapshot.coords, indices=ring_index)
+        boundary_index = np.repeat(np.arange(snapshot.count), np.diff(snapshot.boundary_ring_offsets))
+        geoms = shapely.multilinestrings(rings, indices=boundary_index)
+        boundaries: list[SnapBoundary] = list()
+        for i, geom in enumerate(geoms):
+            admin_level = int(snapshot.admin_level[i])
+            if admin_level == NULL_ADMIN_LEVEL:
+                continue
+            names = {column: snapshot.name(i, column) for column in NAME_COLUMNS}
+            boundaries.append(SnapBoundary(int(snapshot.osm_id[i]), admin_level, snapshot.ancestors(i), names, geom))
+        print(f"build snap index with {len(boundaries)} boundaries from snapshot")
+        return cls(boundaries)
+
+    def distance_meters(self, geom, lon: float, lat: float) -> float:
+        # 在点附近使用等距圆柱投影近似计算距离，几米到几公里的范围内误差可以忽略
+        nearest = shapely.get_coordinates(shapely.shortest_line(shapely.Point(lon, lat), geom))[-1]
+        dx = (nearest[0] - lon) * METERS_PER_DEGREE * math.cos(math.radians(lat))
+        dy = (nearest[1] - lat) * METERS_PER_DEGREE
+        return math.hypot(dx, dy)
+
+    def ancestors(self, osm_id: int) -> list[SnapBoundary]:
+        result: list[SnapBoundary] = list()
+        seen: set[int] = {osm_id}
+        queue: list[int] = list(self.boundaries[osm_id].super_area_id_list)
+        while queue:
+            boundary_id = queue.pop(0)
+            if boundary_id in seen or boundary_id not in self.boundaries:
+                continue
+            seen.add(boundary_id)
+            result.append(self.boundaries[boundary_id])
+            queue += self.boundaries[boundary_id].super_area_id_list
+        return result
+
+    def nearest_chain(self, lon: float, lat: float, max_distance: float, name_column: str = "name",
+                      max_admin_level: int = 11) -> Optional[tuple[list[Optional[str]], float, list[tuple[int, int]]]]:
+        """
+        @max_distance: 允许吸附的最大距离（米）
+        返回 (自顶向下的名称列表, 到最近边界的距离, 每一级的 (admin_level, osm_id))，阈值内没有边界时返回 None
+        """
+        point = shapely.Point(lon, lat)
+        # 经度方向一度对应的距离随纬度变小，按纬度放大搜索半径，最终以米为单位再过滤一次
+        search_degree = max_distance / METERS_PER_DEGREE / max(math.cos(math.radians(lat)), 0.01)
+        for admin_level in self.admin_levels:
+            if admin_level > max_admin_level:
+                continue
+            tree, items = self.trees[admin_level]
+            # 经度方向被拉伸，按度最近的边界按米不一定最近，取搜索半径内的全部边界逐个按米计算距离
+            hits = tree.query(point, predicate="dwithin", distance=search_degree)
+            if len(hits) == 0:
+                continue
+            candidates = [(self.distance_meters(items[i].geom, lon, lat), items[i]) for i in hits]
+            distance, nearest = min(candidates, key=lambda x: x[0])
+            if distance > max_distance:
+                continue
+            chain = [boundary for boundary in self.ancestors(nearest.osm_id) if boundary.admin_level <= max_admin_level]
+            chain.append(nearest)
+            chain.sort(key=lambda x: x.admin_level)
+            return ([boundary.names.get(name_column) for boundary in chain], distance,
+                    [(boundary.admin_level, boundary.osm_id) for boundary in chain])
+        return None
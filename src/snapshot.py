@@ -0,0 +1,279 @@
+"""
+query snapshot: 为查询进程准备的只读、可 mmap 的边界数据文件
+
+文件格式（小端）:
+ - 8 byte magic `MITSNAP1`
+ - 8 byte uint64 header 长度
+ - header: utf-8 json，记录每个数组的 dtype、shape 与在文件中的 offset
+ - 各数组按 64 byte 对齐依次排列
+
+多个 QueryWorker 进程 mmap 同一个文件时共享同一份 page cache，
+加载时不需要反序列化任何 WKB，因此启动耗时与数据量基本无关。
+"""
+import os
+import json
+import mmap
+import numpy as np
+from typing import Optional
+from model import *
+
+MAGIC = b"MITSNAP1"
+ALIGNMENT = 64
+# 空间索引中每个叶子节点包含的 boundary 数量
+INDEX_NODE_SIZE = 16
+NAME_COLUMNS = ("name", "name_en", "name_zh", "name_preference")
+# admin_level 为空时写入的占位值，保证排序时排在最后
+NULL_ADMIN_LEVEL = 127
+
+
+def _pack_strings(values: list[Optional[str]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    valid = np.zeros(len(values), dtype=np.uint8)
+    chunks: list[bytes] = list()
+    for i, value in enumerate(values):
+        encoded = value.encode("utf-8") if value is not None else b""
+        valid[i] = value is not None
+        chunks.append(encoded)
+        offsets[i + 1] = offsets[i] + len(encoded)
+    return offsets, np.frombuffer(b"".join(chunks), dtype=np.uint8), valid
+
+
+def _collect_ancestors(boundaries: dict[int, Boundary], osm_id: int) -> list[int]:
+    ancestors: list[int] = list()
+    seen: set[int] = {osm_id}
+    queue: list[int] = list(boundaries[osm_id].super_area_id_list)
+    while queue:
+        boundary_id = queue.pop(0)
+        if boundary_id in seen or boundary_id not in boundaries:
+            continue
+        seen.add(boundary_id)
+        ancestors.append(boundary_id)
+        queue += boundaries[boundary_id].super_area_id_list
+    ancestors.sort(key=lambda x: boundaries[x].admin_level if boundaries[x].admin_level is not None else NULL_ADMIN_LEVEL)
+    return ancestors
+
+
+def _build_index_order(bbox: np.ndarray) -> np.ndarray:
+    # Sort-Tile-Recursive: 先按中心点经度切片，每个切片内再按纬度排序
+    count = len(bbox)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    center_x = (bbox[:, 0] + bbox[:, 2]) / 2
+    center_y = (bbox[:, 1] + bbox[:, 3]) / 2
+    node_count = -(-count // INDEX_NODE_SIZE)
+    slice_size = INDEX_NODE_SIZE * int(np.ceil(np.sqrt(node_count)))
+    by_x = np.argsort(center_x, kind="stable")
+    order: list[np.ndarray] = list()
+    for i in range(0, count, slice_size):
+        part = by_x[i:i + slice_size]
+        order.append(part[np.argsort(center_y[part], kind="stable")])
+    return np.concatenate(order).astype(np.int64)
+
+
+def export_query_snapshot(boundaries: dict[int, Boundary], snapshot_path: str = "db/boundary.snapshot") -> int:
+    import shapely
+
+    osm_ids: list[int] = list()
+    admin_levels: list[int] = list()
+    bboxes: list[tuple[float, float, float, float]] = list()
+    boundary_ring_offsets: list[int] = [0]
+    ring_offsets: list[int] = [0]
+    coords: list[np.ndarray] = list()
+    ancestor_offsets: list[int] = [0]
+    ancestor_ids: list[int] = list()
+    names: dict[str, list[Optional[str]]] = {column: list() for column in NAME_COLUMNS}
+
+    for boundary in boundaries.values():
+        if boundary.geom is None or boundary.geom.is_empty:
+            continue
+        osm_ids.append(boundary.osm_id)
+        admin_levels.append(boundary.admin_level if boundary.admin_level is not None else NULL_ADMIN_LEVEL)
+        bboxes.append(tuple(boundary.geom.bounds))
+        for polygon in shapely.get_parts(boundary.geom):
+            for ring in shapely.get_rings(polygon):
+                ring_coords = shapely.get_coordinates(ring)
+                coords.append(ring_coords)
+                ring_offsets.append(ring_offsets[-1] + len(ring_coords))
+        boundary_ring_offsets.append(len(ring_offsets) - 1)
+        ancestors = _collect_ancestors(boundaries, boundary.osm_id)
+        ancestor_ids += ancestors
+        ancestor_offsets.append(len(ancestor_ids))
+        for column in NAME_COLUMNS:
+            names[column].append(getattr(boundary, column))
+
+    bbox = np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+    index_order = _build_index_order(bbox)
+    node_bbox = np.array([(bbox[node, 0].min(), bbox[node, 1].min(), bbox[node, 2].max(), bbox[node, 3].max())
+                          for node in (index_order[i:i + INDEX_NODE_SIZE]
+                                       for i in range(0, len(index_order), INDEX_NODE_SIZE))],
+                         dtype=np.float64).reshape(-1, 4)
+
+    arrays: dict[str, np.ndarray] = {
+        "osm_id": np.array(osm_ids, dtype=np.int64),
+        "admin_level": np.array(admin_levels, dtype=np.int32),
+        "bbox": bbox,
+        "boundary_ring_offsets": np.array(boundary_ring_offsets, dtype=np.int64),
+        "ring_offsets": np.array(ring_offsets, dtype=np.int64),
+        "coords": np.concatenate(coords).astype(np.float64) if coords else np.zeros((0, 2), dtype=np.float64),
+        "ancestor_offsets": np.array(ancestor_offsets, dtype=np.int64),
+        "ancestor_ids": np.array(ancestor_ids, dtype=np.int64),
+        "index_order": index_order,
+        "index_node_bbox": node_bbox,
+    }
+    for column in NAME_COLUMNS:
+        offsets, data, valid = _pack_strings(names[column])
+        arrays[f"{column}_offsets"] = offsets
+        arrays[f"{column}_data"] = data
+        arrays[f"{column}_valid"] = valid
+
+    header: dict = {"version": 1, "count": len(osm_ids), "index_node_size": INDEX_NODE_SIZE, "arrays": dict()}
+    # 先计算 header 长度再回填 offset，offset 的位数变化会影响 header 长度，因此迭代到稳定为止
+    data_start = 0
+    while True:
+        offset = data_start
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset = -(-(offset + array.nbytes) // ALIGNMENT) * ALIGNMENT
+        header_bytes = json.dumps(header).encode("utf-8")
+        new_data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+        if new_data_start == data_start:
+            file_size = offset
+            break
+        data_start = new_data_start
+
+    # 先写临时文件再 rename，保证正在 mmap 旧文件的进程不会读到写了一半的数据
+    tmp_path = f"{snapshot_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        # 补齐末尾的对齐空间，保证空数组的 offset 也在文件范围内
+        f.truncate(file_size)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, snapshot_path)
+    print(f"export query snapshot: {len(osm_ids)} boundaries, {len(ring_offsets) - 1} rings, "
+          f"{int(arrays['coords'].shape[0])} coordinates. saved as {snapshot_path}")
+    return len(osm_ids)
+
+
+def load_boundaries(db_path: str, spatial_extension_path: Optional[str] = None) -> dict[int, Boundary]:
+    """读取数据库 relation 表中的全部 boundary，只包含导出 snapshot 需要的字段"""
+    import shapely
+    from utils_duckdb import connect, load_spatial_extension
+
+    conn = connect(db_path, read_only=True)
+    try:
+        load_spatial_extension(conn, spatial_extension_path)
+        rows = conn.execute(f'select osm_id, {", ".join(NAME_COLUMNS)}, admin_level, super_area_id_list, '
+                            'ST_AsWKB(geom) from relation where geom is not null').fetchall()
+    finally:
+        conn.close()
+    boundaries: dict[int, Boundary] = dict()
+    for osm_id, name, name_en, name_zh, name_preference, admin_level, super_area_id_list, geom_wkb in rows:
+        boundary = Boundary(osm_id, name, name_en, name_zh, name_preference, admin_level, list(), list(), list())
+        if super_area_id_list:
+            boundary.super_area_id_list = list(super_area_id_list)
+        boundary.geom = shapely.from_wkb(bytes(geom_wkb))
+        boundaries[osm_id] = boundary
+    return boundaries
+
+
+class QuerySnapshot:
+    """以只读 mmap 方式加载 query snapshot，所有数组都是文件页的零拷贝视图"""
+    def __init__(self, snapshot_path: str = "db/boundary.snapshot"):
+        self.snapshot_path: str = snapshot_path
+        with open(snapshot_path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{snapshot_path} is not a query snapshot")
+        header_len = int.from_bytes(self.mmap[len(MAGIC):len(MAGIC) + 8], "little")
+        self.header: dict = json.loads(self.mmap[len(MAGIC) + 8:len(MAGIC) + 8 + header_len])
+        self.count: int = self.header["count"]
+        self.index_node_size: int = self.header["index_node_size"]
+        self.arrays: dict[str, np.ndarray] = dict()
+        for name, meta in self.header["arrays"].items():
+            dtype = np.dtype(meta["dtype"])
+            shape = tuple(meta["shape"])
+            self.arrays[name] = np.frombuffer(self.mmap, dtype=dtype, count=int(np.prod(shape)),
+                                              offset=meta["offset"]).reshape(shape)
+        self.osm_id = self.arrays["osm_id"]
+        self.admin_level = self.arrays["admin_level"]
+        self.bbox = self.arrays["bbox"]
+        self.boundary_ring_offsets = self.arrays["boundary_ring_offsets"]
+        self.ring_offsets = self.arrays["ring_offsets"]
+        self.coords = self.arrays["coords"]
+        self.index_order = self.arrays["index_order"]
+        self.index_node_bbox = self.arrays["index_node_bbox"]
+        self._index_by_osm_id: Optional[dict[int, int]] = None
+
+    def close(self) -> None:
+        self.arrays.clear()
+        self.osm_id = self.admin_level = self.bbox = self.boundary_ring_offsets = None
+        self.ring_offsets = self.coords = self.index_order = self.index_node_bbox = None
+        self.mmap.close()
+
+    def prefault(self) -> None:
+        """把全部文件页预先读入 page cache，避免刚切换到新版本时的查询因缺页而变慢"""
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self.mmap.madvise(mmap.MADV_WILLNEED)
+        int(np.frombuffer(self.mmap, dtype=np.uint8)[::mmap.PAGESIZE].sum())
+
+    def index_of(self, osm_id: int) -> Optional[int]:
+        if self._index_by_osm_id is None:
+            self._index_by_osm_id = {int(x): i for i, x in enumerate(self.osm_id)}
+        return self._index_by_osm_id.get(osm_id)
+
+    def name(self, index: int, column: str = "name") -> Optional[str]:
+        if not self.arrays[f"{column}_valid"][index]:
+            return None
+        offsets = self.arrays[f"{column}_offsets"]
+        return bytes(self.arrays[f"{column}_data"][offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def ancestors(self, index: int) -> list[int]:
+        offsets = self.arrays["ancestor_offsets"]
+        return [int(x) for x in self.arrays["ancestor_ids"][offsets[index]:offsets[index + 1]]]
+
+    def candidates(self, lon: float, lat: float) -> np.ndarray:
+        node_bbox = self.index_node_bbox
+        node_hit = np.nonzero((node_bbox[:, 0] <= lon) & (lon <= node_bbox[:, 2]) &
+                              (node_bbox[:, 1] <= lat) & (lat <= node_bbox[:, 3]))[0]
+        if len(node_hit) == 0:
+            return np.zeros(0, dtype=np.int64)
+        members = np.concatenate([self.index_order[i * self.index_node_size:(i + 1) * self.index_node_size]
+                                  for i in node_hit])
+        bbox = self.bbox[members]
+        return members[(bbox[:, 0] <= lon) & (lon <= bbox[:, 2]) & (bbox[:, 1] <= lat) & (lat <= bbox[:, 3])]
+
+    def contains(self, index: int, lon: float, lat: float) -> bool:
+        # even-odd 射线法，同时处理外环与内环
+        first_ring = self.boundary_ring_offsets[index]
+        last_ring = self.boundary_ring_offsets[index + 1]
+        start = self.ring_offsets[first_ring]
+        end = self.ring_offsets[last_ring]
+        coords = self.coords[start:end]
+        x1, y1 = coords[:-1, 0], coords[:-1, 1]
+        x2, y2 = coords[1:, 0], coords[1:, 1]
+        cross = (y1 > lat) != (y2 > lat)
+        # 相邻两个环首尾之间的连线不是真实的边
+        cross[self.ring_offsets[first_ring + 1:last_ring] - start - 1] = False
+        edges = np.nonzero(cross)[0]
+        if len(edges) == 0:
+            return False
+        x_intersect = (x2[edges] - x1[edges]) * (lat - y1[edges]) / (y2[edges] - y1[edges]) + x1[edges]
+        return bool(np.count_nonzero(lon < x_intersect) % 2 == 1)
+
+    def query(self, lon: float, lat: float, name_column: str = "name",
+              max_admin_level: int = 11) -> list[Optional[str]]:
+        return [name for _, _, name in self.query_chain(lon, lat, name_column, max_admin_level)]
+
+    # 与 query 相同，但同时返回每一级的 (admin_level, osm_id, name)
+    def query_chain(self, lon: float, lat: float, name_column: str = "name",
+                    max_admin_level: int = 11) -> list[tuple[int, int, Optional[str]]]:
+        hits = [int(i) for i in self.candidates(lon, lat)
+                if self.admin_level[i] <= max_admin_level and self.contains(int(i), lon, lat)]
+        hits.sort(key=lambda i: self.admin_level[i])
+        return [(int(self.admin_level[i]), int(self.osm_id[i]), self.name(i, name_column)) for i in hits]
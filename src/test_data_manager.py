@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import data_manager
+from data_manager import DataManager, Region
+
+
+class FileServer(ThreadingHTTPServer):
+    """
+    只在本地监听的文件服务，支持 ETag、If-None-Match、Range 与 If-Range。
+    files 为 路径 -> 内容，corrupt 中的路径在下一次请求时返回错误的内容，用于模拟 md5 校验失败
+    """
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileHandler)
+        self.files: dict[str, bytes] = dict()
+        self.corrupt: set[str] = set()
+        self.requests: list[tuple[str, dict[str, str]]] = list()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def publish(self, path: str, content: bytes, with_md5: bool = True) -> None:
+        self.files[path] = content
+        if with_md5:
+            self.files[f"{path}.md5"] = f"{hashlib.md5(content).hexdigest()}  {path.rsplit('/', 1)[-1]}".encode()
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server: FileServer = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        content = server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        if self.path in server.corrupt:
+            server.corrupt.discard(self.path)
+            content = content[::-1]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get("Range") and self.headers.get("If-Range") == etag:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+        if start >= len(content) > 0:
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if start > 0 else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(content) - start))
+        if start > 0:
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    # 重试之间不需要真的等待
+    monkeypatch.setattr(data_manager.time, "sleep", lambda seconds: None)
+    config_path = tmp_path / "data.ini"
+    config_path.write_text(f"[download]\noutput_dir = {tmp_path / 'data'}\nchunk_size = 16\nmax_retry = 3\n")
+    return DataManager(str(config_path))
+
+
+def region(server: FileServer, name: str, path: str) -> Region:
+    return Region(name, "", "", f"{server.url}{path}")
+
+
+def test_resume_part_file(server, manager):
+    content = bytes(range(256)) * 8
+    server.publish("/asia/china.osm.pbf", content)
+    china = region(server, "China", "/asia/china.osm.pbf")
+    path = manager.local_path(china)
+    etag = f'"{hashlib.md5(content).hexdigest()}"'
+    os.makedirs(manager.output_dir, exist_ok=True)
+    with open(f"{path}.part", "wb") as f:
+        f.write(content[:1000])
+    with open(f"{path}.meta.json", "w") as f:
+        json.dump({"part_etag": etag}, f)
+
+    [result] = manager.download([china])
+
+    assert result.status == "downloaded"
+    assert result.message == "resumed"
+    assert result.bytes_downloaded == len(content) - 1000
+    with open(path, "rb") as f:
+        assert f.read() == content
+    file_requests = [headers for request_path, headers in server.requests if request_path == "/asia/china.osm.pbf"]
+    assert file_requests[-1]["Range"] == "bytes=1000-"
+
+
+def test_skip_unchanged_by_md5(server, manager):
+    server.publish("/asia/taiwan.osm.pbf", b"taiwan" * 100)
+    taiwan = region(server, "Taiwan", "/asia/taiwan.osm.pbf")
+    assert manager.download([taiwan])[0].status == "downloaded"
+    server.requests.clear()
+
+    [result] = manager.download([taiwan])
+
+    assert result.status == "unchanged"
+    assert result.message == "md5 match"
+    # 只请求了 md5 文件，没有重新下载数据
+    assert [request_path for request_path, _ in server.requests] == ["/asia/taiwan.osm.pbf.md5"]
+
+
+def test_skip_not_modified_without_md5(server, manager):
+    server.publish("/asia/japan.osm.pbf", b"japan" * 100, with_md5=False)
+    japan = region(server, "Japan", "/asia/japan.osm.pbf")
+    assert manager.download([japan])[0].status == "downloaded"
+
+    [result] = manager.download([japan])
+
+    assert result.status == "unchanged"
+    assert result.message == "not modified"
+    assert "If-None-Match" in server.requests[-1][1]
+
+
+def test_retry_after_md5_mismatch(server, manager):
+    content = b"korea" * 100
+    server.publish("/asia/korea.osm.pbf", content)
+    server.corrupt.add("/asia/korea.osm.pbf")
+    korea = region(server, "Korea", "/asia/korea.osm.pbf")
+
+    [result] = manager.download([korea])
+
+    assert result.status == "downloaded"
+    with open(result.path, "rb") as f:
+        assert f.read() == content
+    file_requests = [request_path for request_path, _ in server.requests if request_path == "/asia/korea.osm.pbf"]
+    assert len(file_requests) == 2
+
+
+def test_on_complete_failure_is_reported_per_region(server, manager):
+    server.publish("/asia/china.osm.pbf", b"china" * 100)
+    server.publish("/asia/taiwan.osm.pbf", b"taiwan" * 100)
+    regions = [region(server, "China", "/asia/china.osm.pbf"), region(server, "Taiwan", "/asia/taiwan.osm.pbf")]
+    processed: list[str] = list()
+
+    def on_complete(result):
+        if result.region.name == "China":
+            raise RuntimeError("parse failed")
+        processed.append(result.region.name)
+
+    results = {result.region.name: result for result in manager.download(regions, on_complete)}
+
+    assert results["China"].status == "process_failed"
+    assert "parse failed" in results["China"].message
+    assert results["Taiwan"].status == "downloaded"
+    assert processed == ["Taiwan"]
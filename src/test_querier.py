@@ -0,0 +1,173 @@
+import pytest
+from shapely import MultiPolygon, box
+
+from model import Boundary
+from querier import QueryWorker
+from query_trace import TraceRecorder
+from snapshot import export_query_snapshot
+
+
+def make_boundary(osm_id: int, admin_level: int, geom, super_area_id_list: list[int] = (),
+                  name_en: str = None) -> Boundary:
+    boundary = Boundary(osm_id, f"n{osm_id}", name_en, None, None, admin_level, list(), list(), list())
+    boundary.geom = geom if isinstance(geom, MultiPolygon) else MultiPolygon([geom])
+    if super_area_id_list:
+        boundary.super_area_id_list = list(super_area_id_list)
+    return boundary
+
+
+def boundaries(name_prefix: str = "n") -> dict[int, Boundary]:
+    items = [make_boundary(1, 2, box(0, 0, 10, 10)), make_boundary(2, 4, box(0, 0, 5, 5), [1])]
+    for item in items:
+        item.name = f"{name_prefix}{item.osm_id}"
+    return {item.osm_id: item for item in items}
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    path = str(tmp_path / "boundary.snapshot")
+    export_query_snapshot(boundaries(), path)
+    return path
+
+
+@pytest.fixture
+def overpass_calls(monkeypatch):
+    calls: list[tuple[float, float]] = list()
+
+    def query_overpass(self, lon, lat, name_suffix, max_admin_level):
+        calls.append((lon, lat))
+        return ["overpass"]
+    monkeypatch.setattr(QueryWorker, "query_overpass", query_overpass)
+    return calls
+
+
+def worker_on_snapshot(tmp_path, snapshot_path: str, **options) -> QueryWorker:
+    # 有 snapshot 时本地查询不需要打开数据库，db_path 可以不存在
+    return QueryWorker(str(tmp_path / "missing.duckdb"), snapshot_path=snapshot_path, **options)
+
+
+def test_warm_cache_does_not_query_overpass(tmp_path, snapshot_path, overpass_calls):
+    recorder = TraceRecorder(str(tmp_path / "trace"), sample_rate=1.0, flush_interval=0)
+    recorder.record(1, 1, "", 11, True, "local", 0.001)
+    recorder.record(1, 1, "", 11, True, "cache", 0.001)
+    # 记录时由 overpass 回答、之后命中缓存的点
+    recorder.record(20, 20, "", 11, True, "cache", 0.001)
+    recorder.record(30, 30, "", 11, True, "overpass", 0.1)
+    recorder.close()
+    worker = worker_on_snapshot(tmp_path, snapshot_path, cache_size=16)
+
+    assert worker.warm_cache([recorder.trace_dir]) == 1
+    assert overpass_calls == []
+    assert worker.cache.keys() == [(1, 1, "", 11, True)]
+    assert worker.query_boundary(1, 1).names == ["n1", "n2"]
+    worker.close()
+
+
+def test_warm_cache_with_overpass(tmp_path, snapshot_path, overpass_calls):
+    recorder = TraceRecorder(str(tmp_path / "trace"), sample_rate=1.0, flush_interval=0)
+    recorder.record(30, 30, "", 11, True, "overpass", 0.1)
+    recorder.record(40, 40, "", 11, False, "cache", 0.1)
+    recorder.close()
+    worker = worker_on_snapshot(tmp_path, snapshot_path, cache_size=16)
+
+    assert worker.warm_cache([recorder.trace_dir], include_overpass=True) == 1
+    assert overpass_calls == [(30, 30)]
+    worker.close()
+
+
+def test_snap_index_is_built_from_snapshot_at_startup(tmp_path, snapshot_path, overpass_calls):
+    worker = worker_on_snapshot(tmp_path, snapshot_path, snap_distance=1000)
+    assert worker.state._snap_index is not None
+    assert worker.state._connection is None
+
+    # 不打开 DuckDB，按到 snapshot 中边界环的距离吸附
+    result = worker.query_boundary(10.005, 1)
+    assert result.source == "snap"
+    assert result.names == ["n1"]
+    assert result.distance == pytest.approx(556, abs=1)
+    assert worker.query_boundary(10.1, 1).source == "overpass"
+    assert worker.state._connection is None
+    worker.close()
+
+
+def publish_snapshot(db_dir, version: str, items: dict[int, Boundary]) -> str:
+    # 只发布 snapshot，查询进程不会打开版本中的数据库
+    from db_version import pointer_path, publish, version_paths
+    paths = version_paths(str(db_dir), "boundary", version, snapshot=True)
+    export_query_snapshot(items, paths.snapshot_path)
+    pointer = pointer_path(str(db_dir))
+    publish(pointer, paths)
+    return pointer
+
+
+def test_reload_switches_version(tmp_path, overpass_calls):
+    pointer = publish_snapshot(tmp_path, "20260101000000000001", boundaries("a"))
+    worker = QueryWorker(version_pointer=pointer, reload_interval=0, cache_size=16)
+    assert worker.query_boundary(1, 1).names == ["a1", "a2"]
+    assert worker.reload() is False
+
+    publish_snapshot(tmp_path, "20260101000000000002", boundaries("b"))
+    assert worker.reload() is True
+    assert worker.version == "20260101000000000002"
+    # 旧版本缓存的 key 在新版本上重新查询过
+    assert worker.cache.get((1, 1, "", 11, True)).names == ["b1", "b2"]
+    assert worker.query_boundary(1, 1).names == ["b1", "b2"]
+    worker.close()
+
+
+def test_reload_keeps_state_used_by_query(tmp_path, overpass_calls):
+    pointer = publish_snapshot(tmp_path, "20260101000000000001", boundaries("a"))
+    worker = QueryWorker(version_pointer=pointer, reload_interval=0)
+    with worker.use_state() as old:
+        publish_snapshot(tmp_path, "20260101000000000002", boundaries("b"))
+        assert worker.reload() is True
+        # 切换后进行中的查询仍然可以使用旧版本
+        assert old.retired and old.snapshot is not None
+        assert old.query_local(1, 1, "", 11).names == ["a1", "a2"]
+        assert worker.query_boundary(1, 1).names == ["b1", "b2"]
+    assert old.snapshot is None
+    assert worker.state.refs == 0
+    worker.close()
+
+
+def test_reload_skips_failed_version(tmp_path, overpass_calls):
+    pointer = publish_snapshot(tmp_path, "20260101000000000001", boundaries("a"))
+    worker = QueryWorker(version_pointer=pointer, reload_interval=0)
+    publish_snapshot(tmp_path, "20260101000000000002", dict())
+    with pytest.raises(ValueError):
+        worker.reload()
+    assert worker.failed_version == "20260101000000000002"
+    assert worker.reload() is False
+    assert worker.version == "20260101000000000001"
+    assert worker.query_boundary(1, 1).names == ["a1", "a2"]
+    worker.close()
+
+
+def test_queries_during_reloads(tmp_path, overpass_calls):
+    import threading
+
+    pointer = publish_snapshot(tmp_path, "20260101000000000000", boundaries("v0-"))
+    worker = QueryWorker(version_pointer=pointer, reload_interval=0)
+    stopped = threading.Event()
+    results: list = list()
+
+    def query():
+        while not stopped.is_set():
+            results.append(worker.query_boundary(1, 1))
+
+    threads = [threading.Thread(target=query) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(1, 11):
+            publish_snapshot(tmp_path, f"202601010000000000{i:02d}", boundaries(f"v{i}-"))
+            assert worker.reload() is True
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    assert results
+    assert all(result.source == "local" and result.names[0][:-1] == result.names[1][:-1] for result in results)
+    assert worker.state.refs == 0
+    assert worker.query_boundary(1, 1).names == ["v10-1", "v10-2"]
+    worker.close()
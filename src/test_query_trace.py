@@ -0,0 +1,40 @@
+import os
+import time
+
+from query_trace import HEADER, RECORD, TraceRecorder, prune_trace_dir, read_traces
+
+
+def write_dead_trace(trace_dir, name: str, records: int, age: float = 0) -> str:
+    # 模拟已经退出的实例留下的文件
+    path = os.path.join(trace_dir, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * (HEADER.size + records * RECORD.size))
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_prune_removes_files_of_dead_instances(tmp_path):
+    trace_dir = str(tmp_path)
+    old = write_dead_trace(trace_dir, "trace-20260101-000000-1-aaaa-0001.bin", 100, age=100)
+    new = write_dead_trace(trace_dir, "trace-20260101-000001-2-bbbb-0001.bin", 100, age=50)
+    max_total_bytes = os.path.getsize(new) + 1
+
+    assert prune_trace_dir(trace_dir, max_total_bytes) == [old]
+    assert os.path.exists(new)
+    assert prune_trace_dir(trace_dir, 10 ** 9, max_age=10) == [new]
+
+
+def test_prune_keeps_files_of_live_recorders(tmp_path):
+    trace_dir = str(tmp_path)
+    dead = write_dead_trace(trace_dir, "trace-20260101-000000-1-aaaa-0001.bin", 100, age=3600)
+    recorder = TraceRecorder(trace_dir, sample_rate=1.0, max_total_bytes=0, max_age=None, flush_interval=0)
+    recorder.record(1, 2, "_en", 8, True, "local", 0.001)
+    recorder.flush()
+    live = recorder.file.name
+
+    assert not os.path.exists(dead)
+    assert prune_trace_dir(trace_dir, 0) == []
+    assert [(record.lon, record.lat, record.name_suffix) for record in read_traces([trace_dir])] == [(1, 2, "_en")]
+    recorder.close()
+    assert prune_trace_dir(trace_dir, 0) == [live]
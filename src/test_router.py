@@ -0,0 +1,96 @@
+import json
+
+import pytest
+import shapely
+from shapely import MultiPolygon, box
+
+from model import Boundary, QueryResult
+from router import PartitionRouter
+from snapshot import export_query_snapshot
+
+
+def make_boundary(osm_id: int, admin_level: int, geom, super_area_id_list: list[int] = (),
+                  name_en: str = None) -> Boundary:
+    boundary = Boundary(osm_id, f"n{osm_id}", name_en, None, None, admin_level, list(), list(), list())
+    boundary.geom = MultiPolygon([geom])
+    if super_area_id_list:
+        boundary.super_area_id_list = list(super_area_id_list)
+    return boundary
+
+
+# 两个国家在 x = 5 处相接，争议区域 3 同时出现在两个分区中
+PARTITIONS = {
+    1: [make_boundary(1, 2, box(0, 0, 5, 10), name_en="one"), make_boundary(2, 4, box(0, 0, 5, 5), [1]),
+        make_boundary(3, 6, box(4, 4, 6, 6), [1])],
+    10: [make_boundary(10, 2, box(5, 0, 10, 10), name_en="ten"), make_boundary(3, 6, box(4, 4, 6, 6), [10])],
+}
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    items = list()
+    for root_id, boundaries in PARTITIONS.items():
+        export_query_snapshot({boundary.osm_id: boundary for boundary in boundaries},
+                              str(tmp_path / f"{root_id}.snapshot"))
+        outline = shapely.union_all([boundary.geom for boundary in boundaries])
+        items.append({"root_boundary_id": root_id, "name": f"n{root_id}", "admin_level": 2,
+                      "db": f"{root_id}.duckdb", "snapshot": f"{root_id}.snapshot",
+                      "bbox": list(outline.bounds), "outline": shapely.to_wkb(outline, hex=True)})
+    path = tmp_path / "partitions.json"
+    path.write_text(json.dumps({"version": 1, "partitions": items}))
+    return str(path)
+
+
+@pytest.fixture
+def router(index_path, monkeypatch):
+    router = PartitionRouter(index_path, max_open=1)
+    overpass_calls: list[tuple[float, float]] = list()
+
+    def query_overpass(lon, lat, name_suffix, max_admin_level):
+        overpass_calls.append((lon, lat))
+        return ["overpass"]
+    monkeypatch.setattr(router, "query_overpass", query_overpass)
+    router.overpass_calls = overpass_calls
+    yield router
+    router.close()
+
+
+def test_query_merges_partitions(router):
+    # 争议区域在两个分区中各出现一次，合并后只保留一次
+    assert [partition.root_boundary_id for partition in router.route(4.5, 4.5)] == [1, 10]
+    result = router.query_boundary(4.5, 4.5)
+    assert result.source == "local"
+    assert result.chain == [(2, 1), (4, 2), (6, 3)]
+    assert result.names == ["n1", "n2", "n3"]
+    assert router.query_boundary(5.5, 4.5).chain == [(2, 10), (6, 3)]
+    # 缺少翻译的名称为 None，不同的 boundary 即使名称相同也都保留
+    assert router.query_boundary(4.5, 4.5, "en").names == ["one", None, None]
+
+
+def test_query_batch_matches_single_queries(router):
+    points = [(1, 1), (5.5, 4.5), (8, 8), (20, 20)]
+    batch = router.query_boundary_batch(points, "en")
+    assert [result.names for result in batch] == [router.query_boundary(*point, "en").names for point in points]
+    assert batch[3].source == "overpass"
+    # 只同时打开一个分区，其余的被关闭
+    assert len(router.workers) == 1
+
+
+def test_merge_prefers_local_then_nearest_snap(router):
+    snap_far = QueryResult(["a"], "snap", 80.0, [(2, 1)])
+    snap_near = QueryResult(["b"], "snap", 20.0, [(2, 10)])
+    result = router.merge(0, 0, "", 11, True, [snap_far, snap_near])
+    assert (result.source, result.distance, result.names) == ("snap", 20.0, ["a", "b"])
+    local = QueryResult(["c"], "local", None, [(4, 2)])
+    result = router.merge(0, 0, "", 11, True, [snap_near, local])
+    assert (result.source, result.distance, result.chain) == ("local", None, [(2, 10), (4, 2)])
+
+
+def test_merge_without_names(router):
+    miss = QueryResult(list(), "miss")
+    assert router.merge(1, 2, "", 11, False, [miss]).source == "miss"
+    assert router.merge(1, 2, "", 11, True, [miss, QueryResult(list(), "error")]).source == "error"
+    assert router.overpass_calls == []
+    result = router.merge(1, 2, "", 11, True, [miss])
+    assert (result.source, result.names) == ("overpass", ["overpass"])
+    assert router.overpass_calls == [(1, 2)]
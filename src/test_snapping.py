@@ -0,0 +1,64 @@
+import pytest
+from shapely import box
+
+from snapping import METERS_PER_DEGREE, SnapBoundary, SnapIndex
+
+
+def boundary(osm_id: int, admin_level: int, geom, super_area_id_list: list[int] = ()) -> SnapBoundary:
+    return SnapBoundary(osm_id, admin_level, list(super_area_id_list), {"name": f"n{osm_id}", "name_en": None}, geom)
+
+
+@pytest.fixture
+def index():
+    return SnapIndex([
+        boundary(1, 2, box(-1, 58, 1, 62)),
+        # 在纬度 60 度附近，C 按度更近，D 按米更近
+        boundary(3, 4, box(10.0, 60.0 + 111 / METERS_PER_DEGREE, 10.1, 60.1), [1]),
+        boundary(4, 4, box(10.0 + 166 / METERS_PER_DEGREE, 59.9, 10.1, 60.0), [1]),
+    ])
+
+
+def test_nearest_chain_compares_candidates_in_meters(index):
+    result = index.nearest_chain(10.0, 60.0, 100)
+    assert result is not None
+    names, distance, chain = result
+    assert names == ["n1", "n4"]
+    assert distance == pytest.approx(83, abs=1)
+    assert chain == [(2, 1), (4, 4)]
+
+
+def test_nearest_chain_without_ancestors(index):
+    names, distance, chain = index.nearest_chain(1.0005, 60.0, 100)
+    assert names == ["n1"]
+    assert distance == pytest.approx(28, abs=1)
+    assert chain == [(2, 1)]
+
+
+def test_nearest_chain_respects_limits(index):
+    assert index.nearest_chain(10.0, 60.0, 50) is None
+    assert index.nearest_chain(10.0, 60.0, 100, max_admin_level=2) is None
+    assert index.nearest_chain(10.0, 60.0, 100, name_column="name_en")[0] == [None, None]
+
+
+def test_from_snapshot_matches_polygon_index(tmp_path):
+    from shapely import MultiPolygon, Polygon
+    from model import Boundary
+    from snapshot import QuerySnapshot, export_query_snapshot
+
+    # 带洞的多边形：洞里的点同样在边界之外，应该吸附到洞的边界
+    geoms = {1: Polygon([(0, 0), (1, 0), (1, 1), (0, 1)], [[(0.4, 0.4), (0.6, 0.4), (0.6, 0.6), (0.4, 0.6)]]),
+             2: box(1.001, 0, 2, 1)}
+    items: dict[int, Boundary] = dict()
+    for osm_id, geom in geoms.items():
+        item = Boundary(osm_id, f"n{osm_id}", None, None, None, 4, list(), list(), list())
+        item.geom = MultiPolygon([geom])
+        items[osm_id] = item
+    path = str(tmp_path / "boundary.snapshot")
+    export_query_snapshot(items, path)
+    snapshot = QuerySnapshot(path)
+    from_snapshot = SnapIndex.from_snapshot(snapshot)
+    from_polygons = SnapIndex([boundary(osm_id, 4, geom) for osm_id, geom in geoms.items()])
+
+    for lon, lat in [(0.5, 0.5), (0.45, 0.599), (0.401, 0.5), (1.0006, 0.5), (-0.001, 0.3), (2.0005, 1.0005), (3, 3)]:
+        assert from_snapshot.nearest_chain(lon, lat, 500) == from_polygons.nearest_chain(lon, lat, 500)
+    snapshot.close()
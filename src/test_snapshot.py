@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import shapely
+from shapely import MultiPolygon, Polygon, box
+
+from model import Boundary
+from snapshot import NULL_ADMIN_LEVEL, QuerySnapshot, export_query_snapshot
+
+
+def make_boundary(osm_id: int, admin_level, geom, super_area_id_list: list[int] = (),
+                  name_en: str = None, name_zh: str = None) -> Boundary:
+    boundary = Boundary(osm_id, f"n{osm_id}", name_en, name_zh, None, admin_level, list(), list(), list())
+    boundary.geom = geom if isinstance(geom, MultiPolygon) else MultiPolygon([geom])
+    if super_area_id_list:
+        boundary.super_area_id_list = list(super_area_id_list)
+    return boundary
+
+
+BOUNDARIES = {boundary.osm_id: boundary for boundary in [
+    make_boundary(1, 2, box(0, 0, 10, 10), name_en="one", name_zh="一"),
+    # 两个部分，其中一个带两个洞
+    make_boundary(2, 4, MultiPolygon([
+        Polygon([(0, 0), (6, 0), (6, 6), (0, 6)],
+                [[(1, 1), (2, 1), (2, 2), (1, 2)], [(3, 3), (5, 3), (4, 5)]]),
+        box(7, 7, 9, 9)]), [1], name_en="two"),
+    # 落在 boundary 2 的洞里
+    make_boundary(3, 6, box(1.2, 1.2, 1.8, 1.8), [2, 1]),
+    make_boundary(4, 6, Polygon([(0.5, 4), (2.5, 4.5), (1.5, 5.5)]), [2, 1], name_zh="四"),
+    make_boundary(5, None, box(2, 2, 8, 8), [1]),
+]}
+
+
+@pytest.fixture(scope="module")
+def snapshot(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("snapshot") / "boundary.snapshot")
+    assert export_query_snapshot(BOUNDARIES, path) == len(BOUNDARIES)
+    snapshot = QuerySnapshot(path)
+    yield snapshot
+    snapshot.close()
+
+
+def expected_chain(lon: float, lat: float, name_column: str, max_admin_level: int) -> list[tuple]:
+    point = shapely.Point(lon, lat)
+    hits = [boundary for boundary in BOUNDARIES.values()
+            if (boundary.admin_level if boundary.admin_level is not None else NULL_ADMIN_LEVEL) <= max_admin_level
+            and boundary.geom.contains(point)]
+    hits.sort(key=lambda x: x.admin_level if x.admin_level is not None else NULL_ADMIN_LEVEL)
+    return [(x.admin_level if x.admin_level is not None else NULL_ADMIN_LEVEL, x.osm_id, getattr(x, name_column))
+            for x in hits]
+
+
+@pytest.mark.parametrize("name_column, max_admin_level", [
+    ("name", 11), ("name_en", 11), ("name_zh", 4), ("name_preference", 11), ("name", NULL_ADMIN_LEVEL)])
+def test_query_chain_matches_shapely(snapshot, name_column, max_admin_level):
+    rng = np.random.default_rng(0)
+    for lon, lat in rng.uniform(-1, 11, size=(2000, 2)):
+        assert snapshot.query_chain(lon, lat, name_column, max_admin_level) == \
+            expected_chain(lon, lat, name_column, max_admin_level)
+
+
+def test_query_chain_in_holes(snapshot):
+    # boundary 2 的洞里没有 boundary 2，但有落在洞里的 boundary 3
+    assert snapshot.query(1.1, 1.1) == ["n1"]
+    assert snapshot.query(1.5, 1.5) == ["n1", "n3"]
+    assert snapshot.query(4, 3.5) == ["n1"]
+    assert snapshot.query(8, 8, "name_en") == ["one", "two"]
+    assert snapshot.query(-1, -1) == []
+
+
+def test_ancestors_and_names(snapshot):
+    index = snapshot.index_of(3)
+    assert snapshot.ancestors(index) == [1, 2]
+    assert snapshot.name(snapshot.index_of(4), "name_zh") == "四"
+    assert snapshot.name(snapshot.index_of(4), "name_en") is None
+    assert int(snapshot.admin_level[snapshot.index_of(5)]) == NULL_ADMIN_LEVEL
+    assert snapshot.index_of(100) is None
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / "empty.snapshot")
+    assert export_query_snapshot(dict(), path) == 0
+    snapshot = QuerySnapshot(path)
+    assert snapshot.count == 0
+    assert snapshot.query_chain(0, 0) == []
+    snapshot.close()
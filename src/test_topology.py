@@ -0,0 +1,65 @@
+import pytest
+import shapely
+from shapely import LineString, Polygon
+
+from topology import (REPAIR_EMPTY, REPAIR_FAILED, REPAIR_GAP_CLOSED, REPAIR_MADE_VALID, REPAIR_NODED,
+                      REPAIR_OK, REPAIR_PARTIAL, close_gaps, polygonize_lines, worst_status)
+
+SQUARE = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+
+
+@pytest.mark.parametrize("geoms, status, polygon_count", [
+    ([LineString(SQUARE)], REPAIR_OK, 1),
+    # overpass 返回的闭合 way 是 Polygon
+    ([Polygon(SQUARE)], REPAIR_OK, 1),
+    # 两条 way 在 (0 0)-(5 0) 上重叠，需要打断后再合并
+    ([LineString([(0, 0), (10, 0), (10, 10)]), LineString([(10, 10), (0, 10), (0, 0), (5, 0)])], REPAIR_NODED, 1),
+    # 首尾相差 0.00005 度
+    ([LineString(SQUARE[:-1] + [(0, 0.00005)])], REPAIR_GAP_CLOSED, 1),
+    # 两个互相穿过的三角形，打断后仍得到无效的环
+    ([LineString([(1, 4), (1, 2), (2, 1), (1, 4)]), LineString([(2, 4), (0, 0), (1, 4), (2, 4)])],
+     REPAIR_MADE_VALID, 4),
+    # 多出一条与其他 way 都不相连的线段
+    ([LineString(SQUARE), LineString([(20, 20), (30, 30)])], REPAIR_PARTIAL, 1),
+    ([LineString([(0, 0), (10, 0), (10, 10)])], REPAIR_FAILED, 0),
+    ([], REPAIR_EMPTY, 0),
+    ([None, LineString()], REPAIR_EMPTY, 0),
+])
+def test_polygonize_lines_status(geoms, status, polygon_count):
+    result = polygonize_lines(geoms)
+    assert result.status == status
+    assert len(result.polygons) == polygon_count
+    assert all(polygon.is_valid for polygon in result.polygons)
+
+
+def test_polygonize_lines_reports_open_points():
+    result = polygonize_lines([LineString(SQUARE), LineString([(20, 20), (30, 30)])])
+    assert result.open_points == {(20.0, 20.0), (30.0, 30.0)}
+    assert shapely.area(result.polygons[0]) == 100
+
+
+def test_polygonize_lines_gap_tolerance():
+    lines = [LineString(SQUARE[:-1] + [(0, 0.5)])]
+    assert polygonize_lines(lines).status == REPAIR_FAILED
+    assert polygonize_lines(lines, gap_tolerance=1).status == REPAIR_GAP_CLOSED
+
+
+def test_close_gaps_pairs_nearest_endpoints_once():
+    lines = [
+        LineString([(0, 0), (1, 0)]),
+        LineString([(1.1, 0), (2, 0)]),
+        # (2 0) 与 (2.05 0)、(1.1 0) 与 (1 0) 在阈值内，其余端点都太远
+        LineString([(2.05, 0), (3, 0)]),
+        LineString([(10, 10), (11, 11)]),
+    ]
+    connectors = close_gaps(lines, 0.2)
+    assert sorted(sorted(connector.coords) for connector in connectors) == [
+        [(1.0, 0.0), (1.1, 0.0)], [(2.0, 0.0), (2.05, 0.0)]]
+
+
+def test_close_gaps_ignores_closed_lines():
+    assert close_gaps([LineString(SQUARE)], 1) == list()
+
+
+def test_worst_status():
+    assert worst_status(REPAIR_OK, REPAIR_PARTIAL, REPAIR_NODED) == REPAIR_PARTIAL
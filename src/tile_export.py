@@ -0,0 +1,308 @@
+"""
+将 relation 表导出为按缩放级别简化的 Mapbox Vector Tiles，替代 plot.py 中全分辨率的 matplotlib 渲染
+
+输出目录结构为 `{output_dir}/{z}/{x}/{y}.pbf`，另有 `metadata.json`（TileJSON）与 `manifest.json`。
+manifest 记录每个 boundary 的几何哈希与范围，再次导出时只重新生成与发生变化的 boundary 相交的瓦片。
+
+依赖 mapbox-vector-tile (`pip install mapbox-vector-tile`)
+
+用法:
+  python tile_export.py --db db/boundary.duckdb --out tiles [--min-zoom 0] [--max-zoom 10] [--highlight 1,2,3]
+"""
+import os
+import json
+import math
+import hashlib
+import argparse
+import numpy as np
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+from model import *
+
+TILE_EXTENT = 4096
+# 瓦片四周额外保留的像素数，避免相邻瓦片拼接处出现缝隙
+TILE_BUFFER = 64
+# 简化时允许的误差（像素）
+SIMPLIFY_PIXELS = 1.0
+LAYER_NAME = "boundary"
+MANIFEST_VERSION = 1
+# 每个 admin_level 开始出现的最小缩放级别
+DEFAULT_MIN_ZOOM_BY_ADMIN_LEVEL: dict[int, int] = {2: 0, 3: 0, 4: 2, 5: 4, 6: 5, 7: 6, 8: 8, 9: 9, 10: 10, 11: 11}
+
+
+class TileFeature(NamedTuple):
+    osm_id: int
+    name: Optional[str]
+    name_en: Optional[str]
+    name_zh: Optional[str]
+    admin_level: Optional[int]
+    highlight: bool
+    # 投影到 [0, 1] x [0, 1] 的 Web Mercator 坐标，y 轴向下
+    geom: any
+
+    def properties(self) -> dict:
+        properties = {"osm_id": self.osm_id, "admin_level": self.admin_level, "highlight": self.highlight}
+        for key in ("name", "name_en", "name_zh"):
+            if getattr(self, key) is not None:
+                properties[key] = getattr(self, key)
+        return properties
+
+    def digest(self) -> str:
+        md5 = hashlib.md5(json.dumps(self.properties(), sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        md5.update(shapely.to_wkb(self.geom))
+        return md5.hexdigest()
+
+
+def lonlat_to_mercator(coords: np.ndarray) -> np.ndarray:
+    lat = np.clip(coords[:, 1], -85.05112878, 85.05112878)
+    x = (coords[:, 0] + 180.0) / 360.0
+    y = (1.0 - np.arcsinh(np.tan(np.radians(lat))) / math.pi) / 2.0
+    return np.column_stack((x, y))
+
+
+def features_from_boundaries(boundary_dict: dict[int, Boundary],
+                             highlight_boundary_id_list: list[int] = ()) -> list[TileFeature]:
+    highlight_boundary_id_set = set(highlight_boundary_id_list)
+    return [TileFeature(boundary.osm_id, boundary.name, boundary.name_en, boundary.name_zh, boundary.admin_level,
+                        boundary.osm_id in highlight_boundary_id_set,
+                        shapely.transform(boundary.geom, lonlat_to_mercator))
+            for boundary in boundary_dict.values()
+            if boundary.geom is not None and not boundary.geom.is_empty]
+
+
+def features_from_database(db_path: str = "db/boundary.duckdb",
+                           highlight_boundary_id_list: list[int] = (),
+                           spatial_extension_path: Optional[str] = None) -> list[TileFeature]:
+    from utils_duckdb import connect, load_spatial_extension
+
+    highlight_boundary_id_set = set(highlight_boundary_id_list)
+    conn = connect(db_path, read_only=True)
+    load_spatial_extension(conn, spatial_extension_path)
+    rows = conn.execute('select osm_id, name, name_en, name_zh, admin_level, ST_AsWKB(geom) from relation '
+                        'where geom is not null').fetchall()
+    conn.close()
+    features: list[TileFeature] = list()
+    for osm_id, name, name_en, name_zh, admin_level, geom_wkb in rows:
+        geom = shapely.from_wkb(bytes(geom_wkb))
+        if geom.is_empty:
+            continue
+        features.append(TileFeature(osm_id, name, name_en, name_zh, admin_level, osm_id in highlight_boundary_id_set,
+                                    shapely.transform(geom, lonlat_to_mercator)))
+    return features
+
+
+def tile_range(bounds: tuple[float, float, float, float], zoom: int,
+               buffer: float = 0.0) -> tuple[int, int, int, int]:
+    n = 1 << zoom
+    min_x, min_y, max_x, max_y = bounds
+    return (max(0, int(math.floor((min_x - buffer) * n))), max(0, int(math.floor((min_y - buffer) * n))),
+            min(n - 1, int(math.floor((max_x + buffer) * n))), min(n - 1, int(math.floor((max_y + buffer) * n))))
+
+
+# worker 进程中的全局状态，由 _init_worker 初始化，避免每个瓦片都序列化一次几何
+_worker_state: dict = dict()
+
+
+def _init_worker(output_dir: str, zoom_features: dict[int, list[tuple[dict, bytes]]]) -> None:
+    _worker_state["output_dir"] = output_dir
+    _worker_state["zoom_features"] = {zoom: [(properties, shapely.from_wkb(geom_wkb))
+                                             for properties, geom_wkb in features]
+                                      for zoom, features in zoom_features.items()}
+
+
+def _split_to_tiles(geom, min_tx: int, min_ty: int, max_tx: int, max_ty: int, n: int,
+                    buffer: float):
+    """
+    将几何裁剪到 [min_tx, max_tx] x [min_ty, max_ty] 范围的瓦片（含 buffer）后递归地一分为四，
+    每一层只裁剪上一层已经裁剪过的结果，每个顶点只参与 O(log 瓦片数) 次裁剪，而不是每个瓦片都裁剪一次完整的几何。
+    逐个返回 ((x, y), 裁剪到该瓦片的几何)，不与几何相交的瓦片不返回
+    """
+    geom = shapely.clip_by_rect(geom, min_tx / n - buffer, min_ty / n - buffer,
+                                (max_tx + 1) / n + buffer, (max_ty + 1) / n + buffer)
+    if geom.is_empty:
+        return
+    if min_tx == max_tx and min_ty == max_ty:
+        yield (min_tx, min_ty), geom
+        return
+    mid_x, mid_y = (min_tx + max_tx) // 2, (min_ty + max_ty) // 2
+    for x0, x1 in ((min_tx, mid_x), (mid_x + 1, max_tx)):
+        for y0, y1 in ((min_ty, mid_y), (mid_y + 1, max_ty)):
+            if x0 <= x1 and y0 <= y1:
+                yield from _split_to_tiles(geom, x0, y0, x1, y1, n, buffer)
+
+
+def _render_tiles(zoom: int, block: tuple[int, int, int, int], tiles: Optional[list[tuple[int, int]]],
+                  feature_indices: list[int]) -> tuple[int, int]:
+    """
+    渲染一个瓦片块。tiles 为 None 时渲染块内与任一 boundary 范围相交的瓦片，否则只渲染 tiles（增量导出）
+    """
+    import mapbox_vector_tile
+
+    features = _worker_state["zoom_features"][zoom]
+    output_dir = _worker_state["output_dir"]
+    n = 1 << zoom
+    scale = TILE_EXTENT * n
+    buffer = TILE_BUFFER / scale
+    block_min_tx, block_min_ty, block_max_tx, block_max_ty = block
+    wanted: Optional[set[tuple[int, int]]] = set(tiles) if tiles is not None else None
+    tile_features: dict[tuple[int, int], list[dict]] = {tile: list() for tile in tiles or ()}
+    for i in feature_indices:
+        properties, geom = features[i]
+        min_tx, min_ty, max_tx, max_ty = tile_range(geom.bounds, zoom, buffer)
+        min_tx, min_ty = max(min_tx, block_min_tx), max(min_ty, block_min_ty)
+        max_tx, max_ty = min(max_tx, block_max_tx), min(max_ty, block_max_ty)
+        if min_tx > max_tx or min_ty > max_ty:
+            continue
+        if wanted is None:
+            # 与范围相交但裁剪后为空的瓦片同样需要处理，以删除上一次导出留下的旧瓦片
+            for tx in range(min_tx, max_tx + 1):
+                for ty in range(min_ty, max_ty + 1):
+                    tile_features.setdefault((tx, ty), list())
+        for (x, y), clipped in _split_to_tiles(geom, min_tx, min_ty, max_tx, max_ty, n, buffer):
+            if wanted is not None and (x, y) not in wanted:
+                continue
+            min_x, min_y = x / n, y / n
+            tile_geom = shapely.transform(clipped, lambda c: (c - (min_x, min_y)) * scale)
+            tile_features[(x, y)].append({"geometry": tile_geom, "properties": properties})
+
+    written, removed = 0, 0
+    for (x, y), items in sorted(tile_features.items()):
+        tile_path = os.path.join(output_dir, str(zoom), str(x), f"{y}.pbf")
+        if not items:
+            if os.path.exists(tile_path):
+                os.remove(tile_path)
+                removed += 1
+            continue
+        data = mapbox_vector_tile.encode([{"name": LAYER_NAME, "features": items}],
+                                         default_options={"extents": TILE_EXTENT, "y_coord_down": True})
+        Path(tile_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(tile_path, "wb") as f:
+            f.write(data)
+        written += 1
+    return written, removed
+
+
+def export_tiles(features: list[TileFeature], output_dir: str = "tiles", min_zoom: int = 0, max_zoom: int = 10,
+                 min_zoom_by_admin_level: Optional[dict[int, int]] = None, processes: Optional[int] = None,
+                 incremental: bool = True, block_size: int = 16) -> None:
+    """
+    @block_size: 每个任务渲染 block_size x block_size 个瓦片，块内的瓦片由同一次递归裁剪得到
+    """
+    try:
+        import mapbox_vector_tile
+    except ImportError:
+        raise ImportError("tile export requires mapbox-vector-tile, install it with `pip install mapbox-vector-tile`")
+
+    if min_zoom_by_admin_level is None:
+        min_zoom_by_admin_level = DEFAULT_MIN_ZOOM_BY_ADMIN_LEVEL
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    params = {"version": MANIFEST_VERSION, "min_zoom": min_zoom, "max_zoom": max_zoom, "extent": TILE_EXTENT,
+              "buffer": TILE_BUFFER, "simplify_pixels": SIMPLIFY_PIXELS,
+              "min_zoom_by_admin_level": {str(k): v for k, v in min_zoom_by_admin_level.items()}}
+    current = {str(feature.osm_id): {"digest": feature.digest(), "bounds": list(feature.geom.bounds)}
+               for feature in features}
+
+    # 增量模式下只重新生成与新增、删除或变化的 boundary 新旧范围相交的瓦片
+    dirty_bounds: Optional[list[tuple[float, float, float, float]]] = None
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("params") == params:
+            dirty_bounds = list()
+            for osm_id in set(previous["boundaries"]) | set(current):
+                old, new = previous["boundaries"].get(osm_id), current.get(osm_id)
+                if old is not None and new is not None and old["digest"] == new["digest"]:
+                    continue
+                dirty_bounds += [tuple(item["bounds"]) for item in (old, new) if item is not None]
+            print(f"incremental tile export: {len(dirty_bounds)} changed boundary extents")
+
+    zoom_features: dict[int, list[tuple[dict, bytes]]] = dict()
+    tasks: list[tuple[int, tuple[int, int, int, int], Optional[list[tuple[int, int]]], list[int]]] = list()
+    for zoom in range(min_zoom, max_zoom + 1):
+        selected = [feature for feature in features
+                    if feature.admin_level is not None
+                    and min_zoom_by_admin_level.get(feature.admin_level, max_zoom + 1) <= zoom]
+        pixel = 1.0 / (TILE_EXTENT * (1 << zoom))
+        simplified = shapely.simplify(np.array([feature.geom for feature in selected], dtype=object),
+                                      SIMPLIFY_PIXELS * pixel, preserve_topology=True)
+        zoom_features[zoom] = list()
+        n = 1 << zoom
+        block_members: dict[tuple[int, int], list[int]] = dict()
+        for feature, geom in zip(selected, simplified):
+            # 小于一个像素的区域在该级别不可见
+            if geom.is_empty or geom.area < pixel * pixel:
+                continue
+            index = len(zoom_features[zoom])
+            zoom_features[zoom].append((feature.properties(), shapely.to_wkb(geom)))
+            min_tx, min_ty, max_tx, max_ty = tile_range(geom.bounds, zoom, TILE_BUFFER * pixel)
+            for bx in range(min_tx // block_size, max_tx // block_size + 1):
+                for by in range(min_ty // block_size, max_ty // block_size + 1):
+                    block_members.setdefault((bx, by), list()).append(index)
+
+        def block_bounds(bx: int, by: int) -> tuple[int, int, int, int]:
+            return (bx * block_size, by * block_size,
+                    min(n - 1, (bx + 1) * block_size - 1), min(n - 1, (by + 1) * block_size - 1))
+
+        if dirty_bounds is not None:
+            dirty_blocks: dict[tuple[int, int], set[tuple[int, int]]] = dict()
+            for bounds in dirty_bounds:
+                min_tx, min_ty, max_tx, max_ty = tile_range(bounds, zoom, TILE_BUFFER * pixel)
+                for tx in range(min_tx, max_tx + 1):
+                    for ty in range(min_ty, max_ty + 1):
+                        dirty_blocks.setdefault((tx // block_size, ty // block_size), set()).add((tx, ty))
+            for (bx, by), tiles in sorted(dirty_blocks.items()):
+                tasks.append((zoom, block_bounds(bx, by), sorted(tiles), block_members.get((bx, by), list())))
+            block_count = len(dirty_blocks)
+        else:
+            for (bx, by), members in sorted(block_members.items()):
+                tasks.append((zoom, block_bounds(bx, by), None, members))
+            block_count = len(block_members)
+        print(f"zoom {zoom}: {len(zoom_features[zoom])} boundaries, {block_count} blocks to render")
+
+    written, removed = 0, 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(output_dir, zoom_features)) as executor:
+        for tile_written, tile_removed in executor.map(_render_tiles, *zip(*tasks)) if tasks else ():
+            written += tile_written
+            removed += tile_removed
+
+    with open(os.path.join(output_dir, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump({"tilejson": "3.0.0", "name": "tiny-mitanimon boundaries", "tiles": ["{z}/{x}/{y}.pbf"],
+                   "minzoom": min_zoom, "maxzoom": max_zoom,
+                   "vector_layers": [{"id": LAYER_NAME, "fields": {"osm_id": "Number", "admin_level": "Number",
+                                                                   "highlight": "Boolean", "name": "String",
+                                                                   "name_en": "String", "name_zh": "String"}}]},
+                  f, ensure_ascii=False)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"params": params, "boundaries": current}, f)
+    os.replace(tmp_path, manifest_path)
+    print(f"export tiles: {written} written, {removed} removed. saved in {output_dir}")
+
+
+def export_boundary_tiles_with_highlight(boundary_dict: dict[int, Boundary], highlight_boundary_id_list: list[int],
+                                         output_dir: str = "tiles", max_zoom: int = 10) -> None:
+    export_tiles(features_from_boundaries(boundary_dict, highlight_boundary_id_list), output_dir, max_zoom=max_zoom)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="export boundaries as mapbox vector tiles")
+    arg_parser.add_argument("--db", default="db/boundary.duckdb")
+    arg_parser.add_argument("--out", default="tiles")
+    arg_parser.add_argument("--min-zoom", type=int, default=0)
+    arg_parser.add_argument("--max-zoom", type=int, default=10)
+    arg_parser.add_argument("--processes", type=int, default=None)
+    arg_parser.add_argument("--highlight", default="", help="comma separated osm ids rendered with highlight=true")
+    arg_parser.add_argument("--full", action="store_true", help="ignore the manifest and render every tile")
+    args = arg_parser.parse_args()
+    highlight = [int(x) for x in args.highlight.split(",") if x.strip()]
+    features = features_from_database(args.db, highlight)
+    export_tiles(features, args.out, args.min_zoom, args.max_zoom, processes=args.processes,
+                 incremental=not args.full)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import numpy as np
+import shapely
+from shapely import LineString, Polygon, STRtree
+from typing import NamedTuple
+
+# 修复状态，按修复力度从小到大排列
+REPAIR_EMPTY = "empty"            # 没有任何可用的 way
+REPAIR_OK = "ok"                  # 直接 polygonize 成功
+REPAIR_NODED = "noded"            # 打断相交处并合并线段后成功
+REPAIR_GAP_CLOSED = "gap_closed"  # 连接了距离很近的端点后成功
+REPAIR_MADE_VALID = "made_valid"  # 存在自相交等无效的环，经 make_valid 修复
+REPAIR_PARTIAL = "partial"        # 得到了部分多边形，但仍有未闭合的线段
+REPAIR_FAILED = "failed"          # 没有得到任何多边形
+REPAIR_SEVERITY = [REPAIR_EMPTY, REPAIR_OK, REPAIR_NODED, REPAIR_GAP_CLOSED,
+                   REPAIR_MADE_VALID, REPAIR_PARTIAL, REPAIR_FAILED]
+
+
+class PolygonizeResult(NamedTuple):
+    polygons: list[Polygon]
+    status: str
+    # 修复后仍未闭合的线段端点，用于定位需要重新获取的 way
+    open_points: set[tuple[float, float]]
+
+
+def worst_status(*statuses: str) -> str:
+    return max(statuses, key=REPAIR_SEVERITY.index)
+
+
+def point_key(coord) -> tuple[float, float]:
+    # OSM 坐标精度为 1e-7
+    return round(float(coord[0]), 7), round(float(coord[1]), 7)
+
+
+def to_lines(geoms: list) -> list:
+    lines = list()
+    for geom in geoms:
+        if geom is None or geom.is_empty:
+            continue
+        # overpass 返回的闭合 way 是 Polygon，只取其边界参与 polygonize
+        if geom.geom_type in ("Polygon", "MultiPolygon"):
+            geom = shapely.boundary(geom)
+        lines += [part for part in shapely.get_parts(geom) if not part.is_empty]
+    return lines
+
+
+def is_clean(cuts, dangles, invalid_rings) -> bool:
+    return cuts.is_empty and dangles.is_empty and invalid_rings.is_empty
+
+
+def close_gaps(lines: list, tolerance: float) -> list:
+    """将未闭合线段中距离小于 tolerance 的端点两两连接"""
+    open_chains = [line for line in lines if not line.is_closed]
+    if not open_chains:
+        return list()
+    endpoints = np.array([coord for line in open_chains for coord in (line.coords[0], line.coords[-1])])
+    # 用 STRtree 只找阈值内的端点对，避免对所有端点构造 n*n 的距离矩阵
+    tree = STRtree(shapely.points(endpoints))
+    left, right = tree.query(shapely.points(endpoints), predicate="dwithin", distance=tolerance)
+    pairs = left < right
+    left, right = left[pairs], right[pairs]
+    distance = np.hypot(endpoints[left, 0] - endpoints[right, 0], endpoints[left, 1] - endpoints[right, 1])
+    # 同一条线段的首尾两端也可以相连，用于闭合只差一小段的环
+    connectors = list()
+    used: set[int] = set()
+    for k in np.argsort(distance, kind="stable"):
+        i, j = int(left[k]), int(right[k])
+        if i in used or j in used or distance[k] == 0:
+            continue
+        used.update((i, j))
+        connectors.append(LineString([endpoints[i], endpoints[j]]))
+    return connectors
+
+
+def polygonize_lines(geoms: list, gap_tolerance: float = 0.0001) -> PolygonizeResult:
+    """
+    由 way 的几何构造多边形，失败时依次尝试:
+     1. unary_union 在相交处打断线段，line_merge 合并首尾相接的线段
+     2. 连接距离小于 gap_tolerance 的未闭合端点
+     3. 对无效的环与多边形执行 make_valid
+    """
+    lines = to_lines(geoms)
+    if not lines:
+        return PolygonizeResult(list(), REPAIR_EMPTY, set())
+
+    status = REPAIR_OK
+    polygons, cuts, dangles, invalid_rings = shapely.polygonize_full(lines)
+    if not is_clean(cuts, dangles, invalid_rings) or polygons.is_empty:
+        status = REPAIR_NODED
+        lines = list(shapely.get_parts(shapely.line_merge(shapely.unary_union(lines))))
+        polygons, cuts, dangles, invalid_rings = shapely.polygonize_full(lines)
+        if not is_clean(cuts, dangles, invalid_rings) or polygons.is_empty:
+            connectors = close_gaps(lines, gap_tolerance)
+            if connectors:
+                status = REPAIR_GAP_CLOSED
+                lines = list(shapely.get_parts(shapely.line_merge(shapely.unary_union(lines + connectors))))
+                polygons, cuts, dangles, invalid_rings = shapely.polygonize_full(lines)
+
+    result = list()
+    for polygon in shapely.get_parts(polygons):
+        if polygon.is_valid:
+            result.append(polygon)
+        else:
+            status = worst_status(status, REPAIR_MADE_VALID)
+            result += polygonal_parts(shapely.make_valid(polygon))
+    for ring in shapely.get_parts(invalid_rings):
+        if len(ring.coords) >= 4:
+            status = worst_status(status, REPAIR_MADE_VALID)
+            result += polygonal_parts(shapely.make_valid(Polygon(ring.coords)))
+
+    open_points: set[tuple[float, float]] = set()
+    for line in shapely.get_parts(dangles):
+        if not line.is_closed:
+            open_points.update((point_key(line.coords[0]), point_key(line.coords[-1])))
+    if not result:
+        status = REPAIR_FAILED
+    elif open_points:
+        status = worst_status(status, REPAIR_PARTIAL)
+    return PolygonizeResult(result, status, open_points)
+
+
+def polygonal_parts(geom) -> list[Polygon]:
+    return [part for part in shapely.get_parts(geom) if part.geom_type == "Polygon" and not part.is_empty]
@@ -0,0 +1,73 @@
+"""
+按记录的速率（或按比例缩放后的速率）回放查询 trace，用于复现线上的查询分布与调优
+
+用法:
+  python trace_replay.py --trace trace/ [--db db/boundary.duckdb] [--snapshot db/boundary.snapshot]
+                         [--speed 1.0] [--cache-size 0] [--allow-overpass]
+ --speed 1 表示按记录的时间间隔回放，2 表示两倍速，0 表示不等待、尽可能快地回放
+"""
+import time
+import argparse
+from metrics import Histogram, InMemoryMetrics
+from querier import QueryWorker
+from query_trace import read_traces
+
+
+def replay(worker: QueryWorker, trace_paths: list[str], speed: float = 1.0, allow_overpass: bool = False) -> None:
+    replayed: dict[str, Histogram] = dict()
+    recorded: dict[str, Histogram] = dict()
+    count = 0
+    max_lag = 0.0
+    first_timestamp = None
+    start = time.perf_counter()
+    for record in read_traces(trace_paths):
+        if first_timestamp is None:
+            first_timestamp = record.timestamp
+        if speed > 0:
+            due = (record.timestamp - first_timestamp) / speed
+            lag = time.perf_counter() - start - due
+            if lag < 0:
+                time.sleep(-lag)
+            else:
+                max_lag = max(max_lag, lag)
+        query_start = time.perf_counter()
+        result = worker.query_boundary(record.lon, record.lat, record.name_suffix.lstrip('_'), record.max_admin_level,
+                                       record.overpass_fallback and allow_overpass)
+        latency = time.perf_counter() - query_start
+        count += 1
+        recorded.setdefault(record.source, Histogram()).observe(record.latency)
+        replayed.setdefault(result.source, Histogram()).observe(latency)
+    elapsed = time.perf_counter() - start
+    print(f"replayed {count} queries in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.1f} q/s), "
+          f"max schedule lag {max_lag * 1000:.1f}ms")
+    for source, histogram in sorted(recorded.items()):
+        print(f"recorded {source}: {histogram}")
+    for source, histogram in sorted(replayed.items()):
+        print(f"replayed {source}: {histogram}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="replay recorded query traces against a query worker")
+    arg_parser.add_argument("--trace", nargs="+", required=True, help="trace files or directories")
+    arg_parser.add_argument("--db", default="db/boundary.duckdb")
+    arg_parser.add_argument("--snapshot", default=None)
+    arg_parser.add_argument("--spatial-extension", default=None)
+    arg_parser.add_argument("--snap-distance", type=float, default=None)
+    arg_parser.add_argument("--cache-size", type=int, default=0)
+    arg_parser.add_argument("--warm", action="store_true", help="warm the result cache from the same traces first")
+    arg_parser.add_argument("--speed", type=float, default=1.0)
+    arg_parser.add_argument("--allow-overpass", action="store_true", help="let recorded misses go to overpass")
+    args = arg_parser.parse_args()
+
+    metrics = InMemoryMetrics()
+    worker = QueryWorker(args.db, metrics=metrics, snapshot_path=args.snapshot,
+                         spatial_extension_path=args.spatial_extension, snap_distance=args.snap_distance,
+                         cache_size=args.cache_size)
+    if args.warm:
+        worker.warm_cache(args.trace, include_overpass=args.allow_overpass)
+    replay(worker, args.trace, args.speed, args.allow_overpass)
+    metrics.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import os
+import duckdb
+from duckdb import DuckDBPyConnection
+from typing import Optional
+
+# 指向本地 spatial.duckdb_extension 文件的环境变量，容器镜像中可以预先放置该文件以避免联网安装
+SPATIAL_EXTENSION_ENV = "MITANIMON_SPATIAL_EXTENSION"
+
+
+def connect(db_path: str, read_only: bool = False,
+            extension_directory: Optional[str] = None) -> DuckDBPyConnection:
+    # 关闭 extension 的自动安装与自动加载，避免在查询时意外触发网络请求
+    config = {
+        "autoinstall_known_extensions": False,
+        "autoload_known_extensions": False,
+    }
+    if extension_directory is not None:
+        config["extension_directory"] = extension_directory
+    return duckdb.connect(db_path, read_only=read_only, config=config)
+
+
+def load_spatial_extension(conn: DuckDBPyConnection, extension_path: Optional[str] = None,
+                           allow_install: bool = False) -> None:
+    """
+    加载 spatial extension，优先级: extension_path > 环境变量 > extension_directory 中已安装的版本。
+    @allow_install: 本地没有可用的 extension 时是否允许联网安装，查询进程应保持为 False
+    """
+    extension_path = extension_path or os.environ.get(SPATIAL_EXTENSION_ENV)
+    if extension_path:
+        conn.execute(f"LOAD '{extension_path}'")
+        return
+    try:
+        conn.load_extension('spatial')
+    except duckdb.Error:
+        if not allow_install:
+            raise
+        conn.install_extension('spatial')
+        conn.load_extension('spatial')